@@ -1,8 +1,9 @@
 import logging
 import deltabot
 import config
+import pipeline
+import sharding
 import os
-import praw
 
 
 def sandbox():
@@ -11,10 +12,16 @@ def sandbox():
 
 def main():
     conf = config.Config(os.getcwd() + '/config/config.json')
-    reddit_client = praw.Reddit(conf.subreddit + ' bot', site_name=conf.site_name)
+    if conf.engine == 'sharded':
+        sharding.run(conf)
+        return
+    reddit_client = deltabot.reddit_client(conf)
 
     bot = deltabot.DeltaBot(conf, reddit_client)
-    bot.go()
+    if conf.engine == 'async':
+        pipeline.AsyncEngine(bot).run()
+    else:
+        bot.go()
 
 
 if __name__ == '__main__':
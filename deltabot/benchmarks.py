@@ -0,0 +1,378 @@
+# encoding: utf-8
+
+"""
+Microbenchmarks for DeltaBot's hot paths, and a load test of the whole bot
+against praw_mocks.
+
+Run from the repository root, e.g.:
+
+    python deltabot/benchmarks.py tokens
+    python deltabot/benchmarks.py load --output load.json
+"""
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import timeit
+import itertools
+import argparse
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+import config
+import db
+import deltabot
+import praw_mocks
+
+TOKENS = ["∆", "&amp;#8710;", "Δ"]
+
+WORDS = ("the a view changed my mind because argument point however evidence "
+         "study people think really would could should about which their").split()
+
+def legacy_str_contains_token(text, tokens):
+    """ The line-by-line matcher that TokenMatcher replaced, kept as the
+    reference implementation for comparisons """
+    lines = text.split('\n')
+    in_quote = False
+    for line in lines:
+        if not line:
+            in_quote = False
+        if in_quote:
+            continue
+        if re.search('(^    |^ *&gt;)', line) is None:
+            for token in tokens:
+                if token in line:
+                    return True
+        else:
+            in_quote = True
+    return False
+
+def random_sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+def random_comment_body(rng, paragraphs=8, token_rate=0.3, quote_rate=0.3):
+    """ Builds a CMV-style comment: prose paragraphs, some quoted replies and
+    code blocks, and an award token somewhere with probability token_rate """
+    blocks = []
+    for _ in range(paragraphs):
+        roll = rng.random()
+        if roll < quote_rate / 2:
+            blocks.append('\n'.join('&gt; ' + random_sentence(rng, 15)
+                for _ in range(rng.randint(1, 3))))
+        elif roll < quote_rate:
+            blocks.append('\n'.join('    ' + random_sentence(rng, 6)
+                for _ in range(rng.randint(1, 4))))
+        else:
+            blocks.append(random_sentence(rng, rng.randint(20, 80)))
+    if rng.random() < token_rate:
+        index = rng.randrange(len(blocks))
+        blocks[index] += ' ' + rng.choice(TOKENS)
+    return '\n\n'.join(blocks)
+
+def bench_tokens(args):
+    rng = random.Random(args.seed)
+    bodies = [random_comment_body(rng) for _ in range(args.comments)]
+    matcher = deltabot.TokenMatcher(TOKENS)
+
+    mismatches = [body for body in bodies if
+        matcher.contains_token(body) != legacy_str_contains_token(body, TOKENS)]
+    if mismatches:
+        print("TokenMatcher disagrees with the legacy matcher on %d bodies"
+            % len(mismatches))
+        return 1
+
+    legacy = min(timeit.repeat(
+        lambda: [legacy_str_contains_token(body, TOKENS) for body in bodies],
+        number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(
+        lambda: [matcher.contains_token(body) for body in bodies],
+        number=1, repeat=args.repeat))
+
+    print("%d comments, average %d chars" % (len(bodies),
+        sum(len(body) for body in bodies) / len(bodies)))
+    print("legacy str_contains_token: %.1f us/comment" % (legacy / len(bodies) * 1e6))
+    print("TokenMatcher:              %.1f us/comment" % (compiled / len(bodies) * 1e6))
+    print("speedup: %.1fx" % (legacy / compiled))
+    return 0
+
+def synthetic_award_rows(rng, count, start_time, end_time):
+    """ Yields award rows for executemany, with a realistic skew: a small set
+    of prolific awardees and many awarders who award the same people """
+    awardees = ['awardee%d' % n for n in range(max(1, count // 20))]
+    awarders = ['awarder%d' % n for n in range(max(1, count // 5))]
+    for n in range(count):
+        awardee = awardees[int(len(awardees) * rng.random() ** 3)]
+        awarding_time = rng.uniform(start_time, end_time)
+        yield ('s%d' % rng.randrange(max(1, count // 10)), 'title', 'text',
+            'op', '/sub', awarding_time,
+            'c%d' % (2 * n), 'awarded text', awardee, '/awarded', awarding_time,
+            'c%d' % (2 * n + 1), 'awarding text', rng.choice(awarders), '/awarding',
+            awarding_time, 'r%d' % rng.randrange(max(1, count // 3)))
+
+def time_queries(manager, samples):
+    results = {}
+    for name, calls in samples.items():
+        start = time.perf_counter()
+        for call in calls:
+            call(manager)
+        results[name] = (time.perf_counter() - start) / len(calls)
+    return results
+
+def bench_db(args):
+    rng = random.Random(args.seed)
+    start_time = datetime.timestamp(datetime(2013, 1, 1))
+    end_time = datetime.timestamp(datetime(2017, 1, 1))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = db.DatabaseManager(os.path.join(tmp, 'awards.db'),
+            schema_version=db.MIGRATIONS.index(db.add_indexes))
+        started = time.perf_counter()
+        with manager.db as conn:
+            conn.executemany('''INSERT INTO awards VALUES (?, ?, ?, ?, ?, ?,
+                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                synthetic_award_rows(rng, args.awards, start_time, end_time))
+        manager.load_id_sets()
+        print("Inserted %d awards in %.1fs" % (args.awards, time.perf_counter() - started))
+
+        def comment(comment_id, author, submission_id='s0'):
+            return SimpleNamespace(id=comment_id, author=SimpleNamespace(name=author),
+                submission=SimpleNamespace(id=submission_id))
+
+        rows = manager.db.execute('''SELECT * FROM awards
+            ORDER BY random() LIMIT ?''', (args.samples,)).fetchall()
+        samples = {
+            # already_awarded_by_bot answers from a set, so time its old query
+            'awards_by_awarding_comment': [
+                lambda m, row=row: m.db.execute(
+                    'SELECT * FROM awards WHERE awarding_comment_id = ?',
+                    (row['awarding_comment_id'],)).fetchall()
+                for row in rows],
+            'fetch_awards_by_awardee': [
+                lambda m, row=row: m.fetch_awards_by_awardee(row['awarded_comment_author'])
+                for row in rows],
+            'fetch_awards_by_month': [
+                lambda m, month=month: m.fetch_awards_by_month(2015, month)
+                for month in range(1, 13)],
+            'previous_awards_in_submission': [
+                lambda m, row=row: m.previous_awards_in_submission(
+                    comment(row['awarded_comment_id'], row['awarded_comment_author'],
+                        row['submission_id']),
+                    comment(row['awarding_comment_id'], row['awarding_comment_author']),
+                    row['root_comment_id'])
+                for row in rows],
+        }
+
+        before = time_queries(manager, samples)
+        started = time.perf_counter()
+        db.migrate(manager.db)
+        print("Migrated to schema version %d in %.1fs" % (manager.schema_version(),
+            time.perf_counter() - started))
+        after = time_queries(manager, samples)
+        manager.db.close()
+
+    print("%-32s %12s %12s %9s" % ('query', 'before (ms)', 'after (ms)', 'speedup'))
+    for name in samples:
+        print("%-32s %12.3f %12.3f %8.0fx" % (name, before[name] * 1e3,
+            after[name] * 1e3, before[name] / after[name]))
+    return 0
+
+def base36(number):
+    """ Writes a number the way reddit writes ids """
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        if not number:
+            return digits
+
+def comment_stream(rng, add_submission, add_comment, edit, users=500, submissions=50,
+        token_rate=0.05, quote_rate=0.3, depth_rate=0.8, short_rate=0.2,
+        edit_rate=0.01):
+    """ Builds a synthetic subreddit through the given callbacks and yields
+    its new comments forever:
+
+        add_submission(author, title, selftext)  returns a submission
+        add_comment(parent, author, body)        returns a comment
+        edit(comment, body)
+
+    Most comments reply to one of the last few comments in their thread, so
+    the trees grow deep, and authors are skewed towards a small set of
+    regulars, who award each other again and again. A share short_rate of
+    the awarding comments are too short, and some of those are later
+    edited to be long enough, which gives the rescans something to find. """
+    names = ['user%d' % n for n in range(users)]
+
+    def author():
+        return names[int(users * rng.random() ** 2)]
+
+    threads = [(add_submission(author(), random_sentence(rng, 8),
+                               random_sentence(rng, 60)), [])
+               for _ in range(submissions)]
+    too_short = []
+    while True:
+        submission, comments = rng.choice(threads)
+        parent = submission
+        if comments and rng.random() < depth_rate:
+            parent = comments[-1 - int(min(len(comments), 5) * rng.random())]
+        if rng.random() < token_rate * short_rate:
+            body = random_sentence(rng, 5) + ' ' + rng.choice(TOKENS)
+        else:
+            body = random_comment_body(rng, rng.randint(1, 6), token_rate, quote_rate)
+        comment = add_comment(parent, author(), body)
+        comments.append(comment)
+        if len(body) < 100:
+            too_short.append((comment, body))
+        if too_short and rng.random() < edit_rate:
+            edited, edited_body = too_short.pop(rng.randrange(len(too_short)))
+            edit(edited, random_comment_body(rng, 3, 0, quote_rate) + '\n\n' + edited_body)
+        yield comment
+
+def synthetic_comment_stream(reddit, rng, **kwargs):
+    """ comment_stream's comments as praw_mocks comments, registered with
+    reddit """
+    next_id = itertools.count(36 ** 6)  # 7 digit ids, unlike praw_mocks.reddit_id
+
+    def add_submission(author, title, selftext):
+        submission = praw_mocks.Submission(author=praw_mocks.Author(author),
+            reddit_session=reddit, id=base36(next(next_id)), title=title,
+            selftext=selftext)
+        reddit.add(submission)
+        return submission
+
+    def add_comment(parent, author, body):
+        comment = praw_mocks.Comment(author=praw_mocks.Author(author), body=body,
+            parent=parent, reddit_session=reddit, id=base36(next(next_id)))
+        reddit.add(comment)
+        reddit.subreddit.comments.append(comment)
+        return comment
+
+    def edit(comment, body):
+        comment.body = body
+
+    return comment_stream(rng, add_submission, add_comment, edit, **kwargs)
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a non-empty list """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def bench_load(args):
+    """ Runs a whole DeltaBot against praw_mocks for args.iterations
+    iterations of args.per_iteration new comments each """
+    rng = random.Random(args.seed)
+    random.seed(args.seed)  # praw_mocks.reddit_id
+    reddit = praw_mocks.Reddit()
+    stream = synthetic_comment_stream(reddit, rng, users=args.users,
+        submissions=args.submissions, token_rate=args.token_rate,
+        quote_rate=args.quote_rate, depth_rate=args.depth_rate,
+        short_rate=args.short_rate, edit_rate=args.edit_rate)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conf = config.Config(dict(config.Config('config/config.json').attrs,
+            database=':memory:' if args.memory else os.path.join(tmp, 'awards.db'),
+            last_comment_filename=None,
+            api_requests_per_minute=1e9, api_burst=1e9,
+            # small enough that rescans and update jobs come due every iteration
+            rescan_interval=1e-3, rescan_max_interval=1e-3,
+            update_debounce_window=1e-3))
+        bot = deltabot.DeltaBot(conf, reddit)
+
+        latencies = []
+        scanned = 0
+        for _ in range(args.iterations):
+            for _ in range(args.per_iteration):
+                next(stream)
+            started = time.perf_counter()
+            scanned += bot.scan_comments()
+            bot.rescan_comments()
+            bot.run_due_jobs()
+            latencies.append(time.perf_counter() - started)
+        dispo_names = {value: key for key, value in deltabot.dispos.items()}
+        logged_dispos = {dispo_names[row['dispo']]: row['count'] for row in
+            bot.db.db.execute('SELECT dispo, count(*) AS count FROM dispo_log GROUP BY dispo')}
+        awards = bot.db.db.execute('SELECT count(*) FROM awards').fetchone()[0]
+        bot.db.db.close()
+
+    api_calls = sum(bot.scheduler.endpoint_calls.values())
+    results = {
+        'benchmark': 'load',
+        'seed': args.seed,
+        'parameters': {name: getattr(args, name) for name in ('iterations',
+            'per_iteration', 'users', 'submissions', 'token_rate', 'quote_rate',
+            'depth_rate', 'short_rate', 'edit_rate', 'memory')},
+        'comments': scanned,
+        'seconds': sum(latencies),
+        'comments_per_second': scanned / sum(latencies),
+        'api_calls': api_calls,
+        'api_calls_per_comment': api_calls / scanned,
+        'api_calls_by_endpoint': dict(bot.scheduler.endpoint_calls),
+        'db_calls_by_method': dict(bot.db.method_calls),
+        'update_phase_seconds': dict(bot.metrics.phase_seconds),
+        'iteration_latency_ms': {'p50': percentile(latencies, 0.5) * 1e3,
+                                 'p99': percentile(latencies, 0.99) * 1e3,
+                                 'max': max(latencies) * 1e3},
+        'dispos': logged_dispos,
+        'awards': awards,
+        'wiki_pages': len(reddit.wiki),
+        'messages_sent': len(reddit.sent_messages),
+    }
+
+    print("%d comments in %d iterations, %d awards" % (scanned, args.iterations, awards))
+    print("throughput:        %.0f comments/s" % results['comments_per_second'])
+    print("API calls:         %.2f per comment" % results['api_calls_per_comment'])
+    print("iteration latency: p50 %.1f ms, p99 %.1f ms" % (
+        results['iteration_latency_ms']['p50'], results['iteration_latency_ms']['p99']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("results written to %s" % args.output)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    tokens = subparsers.add_parser('tokens',
+        help="TokenMatcher against the legacy line-by-line matcher")
+    tokens.add_argument('--comments', type=int, default=5000)
+    tokens.set_defaults(func=bench_tokens)
+
+    database = subparsers.add_parser('db',
+        help="DatabaseManager queries before and after the indexing migration")
+    database.add_argument('--awards', type=int, default=1000000)
+    database.add_argument('--samples', type=int, default=200)
+    database.set_defaults(func=bench_db)
+
+    load = subparsers.add_parser('load',
+        help="a whole DeltaBot scanning a synthetic comment stream from praw_mocks")
+    load.add_argument('--iterations', type=int, default=50)
+    load.add_argument('--per-iteration', type=int, default=200,
+        help="new comments per iteration, at most the listing's 1000")
+    load.add_argument('--users', type=int, default=500)
+    load.add_argument('--submissions', type=int, default=50)
+    load.add_argument('--token-rate', type=float, default=0.05)
+    load.add_argument('--quote-rate', type=float, default=0.3)
+    load.add_argument('--depth-rate', type=float, default=0.8,
+        help="share of comments that reply to a comment rather than the submission")
+    load.add_argument('--short-rate', type=float, default=0.2,
+        help="share of awarding comments that are too short")
+    load.add_argument('--edit-rate', type=float, default=0.01)
+    load.add_argument('--memory', action='store_true',
+        help="use an in-memory database instead of a temporary file")
+    load.add_argument('--output', help="write the results to this JSON file")
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
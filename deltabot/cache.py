@@ -0,0 +1,126 @@
+import time
+import threading
+import collections
+
+
+class LRUDict(object):
+    """ A dict holding at most maxsize items, evicting the least recently
+    used one when full. Safe to share between threads. """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class AncestorCache(object):
+    """
+    Remembers each comment's parent and the root comment of its tree, keyed
+    by fullname. fetch_parent_id is called with a comment fullname whenever
+    the parent isn't cached and must return that comment's parent_id.
+    """
+
+    def __init__(self, fetch_parent_id, maxsize=10000):
+        self.fetch_parent_id = fetch_parent_id
+        self.parents = LRUDict(maxsize)
+        self.roots = LRUDict(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, name, parent_id):
+        self.parents[name] = parent_id
+
+    def first_unknown(self, name):
+        """ Returns the first comment at or above the given one whose parent
+        isn't cached, or None if its root can be found without fetching """
+        while name not in self.roots:
+            parent = self.parents.get(name)
+            if parent is None:
+                return name
+            if parent.startswith('t3_'):
+                return None
+            name = parent
+        return None
+
+    def root_of(self, name, parent_id=None):
+        """ Returns the fullname of the root comment above the given comment,
+        which is the comment itself if it is top level. The walk stops at the
+        first ancestor whose root is already known. """
+        if parent_id is not None:
+            self.add(name, parent_id)
+        path = []
+        while True:
+            root = self.roots.get(name)
+            if root is not None:
+                self.hits += 1
+                break
+            parent = self.parents.get(name)
+            if parent is None:
+                self.misses += 1
+                parent = self.fetch_parent_id(name)
+                self.add(name, parent)
+            else:
+                self.hits += 1
+            path.append(name)
+            if parent.startswith('t3_'):  # Parent is the submission
+                root = name
+                break
+            name = parent
+        for visited in path:
+            self.roots[visited] = root
+        return root
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'parents': len(self.parents), 'roots': len(self.roots)}
+
+    def clear(self):
+        self.parents.clear()
+        self.roots.clear()
+
+
+class ExpiringValue(object):
+    """ Caches the result of load for ttl seconds """
+
+    def __init__(self, load, ttl, clock=time.monotonic):
+        self.load = load
+        self.ttl = ttl
+        self.clock = clock
+        self.value = None
+        self.loaded_at = None
+
+    def get(self):
+        now = self.clock()
+        if self.loaded_at is None or now - self.loaded_at >= self.ttl:
+            self.value = self.load()
+            self.loaded_at = now
+        return self.value
+
+    def invalidate(self):
+        self.value = None
+        self.loaded_at = None
@@ -0,0 +1,59 @@
+"""
+Tracks how far the comment scan has got, so that a restart resumes exactly
+where the last run stopped. Comment ids are base 36 and handed out in
+increasing order, so comments can be ordered by their fullnames alone and no
+anchor comment has to be looked up.
+"""
+import collections
+
+
+def fullname_key(fullname):
+    """ Orders fullnames by id, e.g. t1_z before t1_10 """
+    return int(fullname.split('_', 1)[1], 36)
+
+
+class ScanCheckpoint(object):
+    """
+    The highest comment fullname processed and a window of the most recently
+    processed fullnames. A comment is new if it is not in the window and
+    sorts above the oldest fullname in it; the window lets a comment that
+    shows up in the listing a little late, behind newer ones, still be seen.
+    """
+
+    def __init__(self, high_water_mark=None, recent=(), window=100):
+        self.high_water_mark = high_water_mark
+        self.recent = collections.deque(recent, window)
+        self.recent_set = set(self.recent)
+        self.update_floor()
+
+    def update_floor(self):
+        self.floor = min(fullname_key(name) for name in self.recent) if self.recent else None
+
+    def is_new(self, fullname):
+        return self.floor is None or \
+            (fullname not in self.recent_set and fullname_key(fullname) > self.floor)
+
+    def is_behind(self, fullname):
+        """ True for comments at or below the window, where the scan can stop
+        paging back through the listing """
+        return self.floor is not None and fullname_key(fullname) <= self.floor
+
+    def advance(self, fullnames):
+        for fullname in fullnames:
+            if len(self.recent) == self.recent.maxlen:
+                self.recent_set.discard(self.recent[0])
+            self.recent.append(fullname)
+            self.recent_set.add(fullname)
+            if self.high_water_mark is None or \
+                    fullname_key(fullname) > fullname_key(self.high_water_mark):
+                self.high_water_mark = fullname
+        self.update_floor()
+
+    def copy(self):
+        return ScanCheckpoint(self.high_water_mark, self.recent, self.recent.maxlen)
+
+    def clear(self):
+        self.high_water_mark = None
+        self.recent.clear()
+        self.recent_set.clear()
+        self.update_floor()
@@ -1,59 +1,327 @@
 from sqlite3 import connect, Row
-from datetime import datetime, timedelta
+from datetime import datetime
+import collections
+import contextlib
+import functools
+import json
+import threading
+
+# Each migration brings the schema up by one version inside its own
+# transaction, and the version reached is kept in PRAGMA user_version.
+# Migrations must also cope with databases created before versioning existed,
+# which already have some of these tables.
+
+def create_tables(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS awards 
+      (submission_id TEXT, submission_title TEXT, submission_self_text TEXT, 
+          submission_author TEXT, submission_url TEXT, submission_time ,
+       awarded_comment_id TEXT, awarded_comment_text TEXT, awarded_comment_author TEXT, 
+          awarded_comment_url TEXT, awarded_comment_time REAL,
+       awarding_comment_id TEXT, awarding_comment_text TEXT, awarding_comment_author TEXT, 
+          awarding_comment_url TEXT, awarding_comment_time REAL)""")
+
+  conn.execute("""CREATE TABLE IF NOT EXISTS dispo_log
+      (comment_id TEXT PRIMARY KEY, dispo INT, reply_id TEXT, comment_time REAL)""")
+
+def add_root_comment_id(conn):
+  # existing rows are backfilled by DeltaBot.backfill_award_roots
+  columns = [row['name'] for row in conn.execute('PRAGMA table_info(awards)')]
+  if 'root_comment_id' not in columns:
+    conn.execute('ALTER TABLE awards ADD COLUMN root_comment_id TEXT')
+
+def add_indexes(conn):
+  conn.execute("""CREATE INDEX IF NOT EXISTS awards_by_awarding_comment
+      ON awards (awarding_comment_id)""")
+  conn.execute("""CREATE INDEX IF NOT EXISTS awards_by_awardee
+      ON awards (awarded_comment_author)""")
+  conn.execute("""CREATE INDEX IF NOT EXISTS awards_by_time
+      ON awards (awarding_comment_time)""")
+  conn.execute("""CREATE INDEX IF NOT EXISTS awards_by_submission
+      ON awards (submission_id, awarding_comment_author, awarded_comment_author,
+                 root_comment_id)""")
+  conn.execute("""CREATE INDEX IF NOT EXISTS dispo_log_by_time
+      ON dispo_log (comment_time)""")
+
+def add_monthly_leaderboard(conn):
+  # months are bucketed in local time to match fetch_awards_by_month
+  conn.execute("""CREATE TABLE IF NOT EXISTS monthly_leaderboard
+      (year INT, month INT, awardee TEXT, num_awards INT, earliest_award_time REAL,
+       PRIMARY KEY (year, month, awardee))""")
+  conn.execute("""INSERT OR REPLACE INTO monthly_leaderboard
+      SELECT CAST(strftime('%Y', awarding_comment_time, 'unixepoch', 'localtime') AS INT),
+             CAST(strftime('%m', awarding_comment_time, 'unixepoch', 'localtime') AS INT),
+             awarded_comment_author, COUNT(*), MIN(awarded_comment_time)
+      FROM awards
+      GROUP BY 1, 2, 3
+      ORDER BY MIN(rowid)""")
+
+def add_flair_mirror(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS flair_mirror
+      (user TEXT PRIMARY KEY, flair_text TEXT, flair_css_class TEXT)""")
+  conn.execute("""CREATE TABLE IF NOT EXISTS bot_state
+      (key TEXT PRIMARY KEY, value)""")
+
+def add_update_jobs(conn):
+  # pending wiki, flair and sidebar updates, one row per target
+  conn.execute("""CREATE TABLE IF NOT EXISTS update_jobs
+      (target TEXT PRIMARY KEY, kind TEXT, args TEXT, due_time REAL, version INT)""")
+  conn.execute("""CREATE INDEX IF NOT EXISTS update_jobs_by_due_time
+      ON update_jobs (due_time)""")
+
+def add_scan_checkpoints(conn):
+  # recent holds a JSON list of fullnames, see checkpoint.ScanCheckpoint
+  conn.execute("""CREATE TABLE IF NOT EXISTS scan_checkpoints
+      (name TEXT PRIMARY KEY, high_water_mark TEXT, recent TEXT)""")
+
+def add_rescan_schedule(conn):
+  columns = [row['name'] for row in conn.execute('PRAGMA table_info(dispo_log)')]
+  if 'next_rescan_time' not in columns:
+    conn.execute('ALTER TABLE dispo_log ADD COLUMN next_rescan_time REAL')
+    conn.execute('ALTER TABLE dispo_log ADD COLUMN rescan_attempts INT NOT NULL DEFAULT 0')
+  # too_little_text (6) is the only rescannable dispo; make those logs due now
+  conn.execute("""UPDATE dispo_log SET next_rescan_time = comment_time
+      WHERE dispo = 6 AND next_rescan_time IS NULL""")
+  conn.execute("""CREATE INDEX IF NOT EXISTS dispo_log_by_next_rescan
+      ON dispo_log (next_rescan_time) WHERE next_rescan_time IS NOT NULL""")
+
+def add_missing_root_index(conn):
+  # covers the backfill's query, and stays empty once the backfill is done
+  conn.execute("""CREATE INDEX IF NOT EXISTS awards_missing_root
+      ON awards (awarded_comment_id, awarding_comment_time)
+      WHERE root_comment_id IS NULL""")
+
+def add_job_attempts(conn):
+  # how many times in a row a job has failed, see DeltaBot.run_due_jobs
+  columns = [row['name'] for row in conn.execute('PRAGMA table_info(update_jobs)')]
+  if 'attempts' not in columns:
+    conn.execute('ALTER TABLE update_jobs ADD COLUMN attempts INT NOT NULL DEFAULT 0')
+
+MIGRATIONS = [
+  create_tables,
+  add_root_comment_id,
+  add_indexes,
+  add_monthly_leaderboard,
+  add_flair_mirror,
+  add_update_jobs,
+  add_scan_checkpoints,
+  add_rescan_schedule,
+  add_missing_root_index,
+  add_job_attempts,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+PRAGMAS = [
+  'PRAGMA journal_mode = WAL',
+  'PRAGMA synchronous = NORMAL',
+  'PRAGMA temp_store = MEMORY',
+  'PRAGMA cache_size = -16000',
+  'PRAGMA busy_timeout = 5000',
+]
+
+def migrate(conn, target_version=SCHEMA_VERSION):
+  """ Applies the migrations needed to bring the database up to target_version """
+  version = conn.execute('PRAGMA user_version').fetchone()[0]
+  for number in range(version, target_version):
+    conn.execute('BEGIN')
+    try:
+      MIGRATIONS[number](conn)
+      conn.execute('PRAGMA user_version = %d' % (number + 1))
+    except:
+      conn.rollback()
+      raise
+    conn.commit()
+
+# A job for a target that already has one pending is folded into it: the
+# pending job keeps its due time and its version is bumped, which tells the
+# worker that the target changed again while the job was running.
+ENQUEUE_JOB = """INSERT INTO update_jobs (target, kind, args, due_time, version)
+    VALUES (:target, :kind, :args, :due_time, 1)
+    ON CONFLICT (target) DO UPDATE SET version = version + 1"""
+
+# helpers the other methods go through, which method_calls leaves out
+UNCOUNTED_METHODS = frozenset(['write', 'flush', 'load_id_sets'])
+
+def synchronized(method):
+  """ Serializes calls to a DatabaseManager method, which lets the async
+  engine share one connection between its worker threads, and counts them
+  in method_calls """
+  name = method.__name__
+  counted = name not in UNCOUNTED_METHODS
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self.lock:
+      if counted:
+        self.method_calls[name] += 1
+      return method(self, *args, **kwargs)
+  return wrapper
 
 class DatabaseManager():
-  def __init__(self, filepath):
-    self.db = connect(filepath)
+  def __init__(self, filepath, schema_version=SCHEMA_VERSION):
+    # schema_version is only lowered to benchmark older schemas
+    self.lock = threading.RLock()
+    self.method_calls = collections.Counter()
+    # each thread has its own unit of work, see unit_of_work
+    self.local = threading.local()
+    self.db = connect(filepath, check_same_thread=False)
     self.db.row_factory = Row
+    for pragma in PRAGMAS:
+      self.db.execute(pragma)
+    migrate(self.db, schema_version)
+    self.load_id_sets()
+
+  @contextlib.contextmanager
+  def unit_of_work(self):
+    """
+    Holds back the writes this thread makes inside the block and commits
+    them in one transaction, with executemany for runs of the same
+    statement, when the outermost block exits. If a block raises, the
+    writes made inside it that haven't been flushed are dropped. flush()
+    commits early; DeltaBot flushes right after every reply so a reply is
+    never left without its dispo log.
+    """
+    local = self.local
+    local.depth = getattr(local, 'depth', 0) + 1
+    if local.depth == 1:
+      local.pending = []
+    pending = local.pending
+    # where the block's writes start: the last statement's rows are
+    # extended in place, so both lengths are needed
+    mark = (len(pending), len(pending[-1][1]) if pending else 0)
+    try:
+      yield
+    except BaseException:
+      self.discard_pending(pending, mark)
+      raise
+    finally:
+      local.depth -= 1
+      if local.depth == 0:
+        self.flush()
+
+  def discard_pending(self, pending, mark):
+    """ Drops the writes held back since mark was taken of pending """
+    if self.local.pending is pending:
+      statements, rows = mark
+      del pending[statements:]
+      if statements:
+        del pending[-1][1][rows:]
+    else:
+      # flushed since, so everything still held back came after the mark
+      self.local.pending = []
+    # the id sets were updated along with the dropped writes
+    self.load_id_sets()
+
+  @synchronized
+  def flush(self):
+    pending = getattr(self.local, 'pending', None)
+    if not pending:
+      return
+    self.local.pending = []
     with self.db as conn:
-        conn.execute("""CREATE TABLE IF NOT EXISTS awards 
-            (submission_id TEXT, submission_title TEXT, submission_self_text TEXT, 
-                submission_author TEXT, submission_url TEXT, submission_time ,
-             awarded_comment_id TEXT, awarded_comment_text TEXT, awarded_comment_author TEXT, 
-                awarded_comment_url TEXT, awarded_comment_time REAL,
-             awarding_comment_id TEXT, awarding_comment_text TEXT, awarding_comment_author TEXT, 
-                awarding_comment_url TEXT, awarding_comment_time REAL)""")
-
-        conn.execute("""CREATE TABLE IF NOT EXISTS dispo_log
-            (comment_id TEXT PRIMARY KEY, dispo INT, reply_id TEXT, comment_time REAL)""")
-        
-
-  def award_point(self, awarded_comment, awarding_comment):
+      for sql, rows in pending:
+        conn.executemany(sql, rows)
+
+  @synchronized
+  def write(self, sql, rows):
+    """ Runs a write statement for each row, now or when the current unit
+    of work is flushed """
+    if getattr(self.local, 'depth', 0):
+      pending = self.local.pending
+      if pending and pending[-1][0] == sql:
+        pending[-1][1].extend(rows)
+      else:
+        pending.append((sql, list(rows)))
+    else:
+      with self.db as conn:
+        conn.executemany(sql, rows)
+
+  @synchronized
+  def load_id_sets(self):
+    """ Loads the ids of the comments in the dispo log and of the comments
+    that have awarded a point. Only comments with a token get logged, so the
+    sets stay small, and they let the lookups made for every scanned comment
+    answer no without a query. """
+    self.logged_comment_ids = set(row[0] for row in
+      self.db.execute('SELECT comment_id FROM dispo_log'))
+    self.awarding_comment_ids = set(row[0] for row in
+      self.db.execute('SELECT awarding_comment_id FROM awards'))
+
+  @synchronized
+  def schema_version(self):
+    return self.db.execute('PRAGMA user_version').fetchone()[0]
+
+  @synchronized
+  def award_point(self, awarded_comment, awarding_comment, root_comment_id, jobs=()):
+    """ Records an award, along with the update jobs it triggers, and
+    returns the row that was stored """
     submission = awarded_comment.submission
-    with self.db as conn:
-      conn.execute("""INSERT INTO awards VALUES
-        (
-          ?, ?, ?, ?, ?, ?,
-          ?, ?, ?, ?, ?,
-          ?, ?, ?, ?, ?
-        )""", 
-        (
-          submission.id, submission.title, submission.selftext, 
-            submission.author.name, submission.permalink, submission.created_utc,
-          awarded_comment.id, awarded_comment.body, awarded_comment.author.name, 
-            awarded_comment.permalink, awarded_comment.created_utc,
-          awarding_comment.id, awarding_comment.body, awarding_comment.author.name, 
-            awarding_comment.permalink, awarding_comment.created_utc
-        )
-      )
-
-  def previous_awards_in_submission(self, awarded_comment, awarding_comment):
+    award = {
+      'submission_id': submission.id, 'submission_title': submission.title,
+        'submission_self_text': submission.selftext,
+        'submission_author': submission.author.name,
+        'submission_url': submission.permalink, 'submission_time': submission.created_utc,
+      'awarded_comment_id': awarded_comment.id, 'awarded_comment_text': awarded_comment.body,
+        'awarded_comment_author': awarded_comment.author.name,
+        'awarded_comment_url': awarded_comment.permalink,
+        'awarded_comment_time': awarded_comment.created_utc,
+      'awarding_comment_id': awarding_comment.id, 'awarding_comment_text': awarding_comment.body,
+        'awarding_comment_author': awarding_comment.author.name,
+        'awarding_comment_url': awarding_comment.permalink,
+        'awarding_comment_time': awarding_comment.created_utc,
+      'root_comment_id': root_comment_id,
+    }
+    awarding_time = datetime.fromtimestamp(award['awarding_comment_time'])
+    with self.unit_of_work():
+      self.write("""INSERT INTO awards (%s) VALUES (%s)""" % (
+        ', '.join(award), ', '.join(':' + column for column in award)), [award])
+      self.write("""INSERT INTO monthly_leaderboard
+        (year, month, awardee, num_awards, earliest_award_time) VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (year, month, awardee) DO UPDATE SET
+          num_awards = num_awards + 1,
+          earliest_award_time = MIN(earliest_award_time, excluded.earliest_award_time)""",
+        [(awarding_time.year, awarding_time.month, award['awarded_comment_author'],
+          award['awarded_comment_time'])])
+      if jobs:
+        self.write(ENQUEUE_JOB, jobs)
+    self.awarding_comment_ids.add(award['awarding_comment_id'])
+    return award
+
+  @synchronized
+  def previous_awards_in_submission(self, awarded_comment, awarding_comment, root_comment_id):
     with self.db:
       cur = self.db.cursor()
       cur.execute('''SELECT awarding_comment_id FROM awards where submission_id = ? 
-        and awarding_comment_author = ? and awarded_comment_author = ?''',
+        and awarding_comment_author = ? and awarded_comment_author = ?
+        and root_comment_id = ?''',
         (awarded_comment.submission.id, awarding_comment.author.name, 
-         awarded_comment.author.name))
+         awarded_comment.author.name, root_comment_id))
       previous_awards = cur.fetchall()
-    return previous_awards
+    return [row['awarding_comment_id'] for row in previous_awards]
 
-  def already_awarded_by_bot(self, awarding_comment):
+  @synchronized
+  def fetch_awarded_comments_missing_root(self, limit=-1):
+    """ Newest first, since previous_awards_in_submission can't see an award
+    until it has a root and recent awards are the ones new awards repeat """
+    # roots that couldn't be found are stored as '', which no root matches
     with self.db:
       cur = self.db.cursor()
-      cur.execute('SELECT * FROM awards WHERE awarding_comment_id = ?', (awarding_comment.id,))
+      cur.execute('''SELECT awarded_comment_id FROM awards
+        WHERE root_comment_id IS NULL GROUP BY awarded_comment_id
+        ORDER BY MAX(awarding_comment_time) DESC LIMIT ?''', (limit,))
       rows = cur.fetchall()
-    return bool(rows)
+    return [row['awarded_comment_id'] for row in rows]
+
+  @synchronized
+  def set_award_root(self, awarded_comment_id, root_comment_id):
+    self.write('''UPDATE awards SET root_comment_id = ?
+      WHERE awarded_comment_id = ? AND root_comment_id IS NULL''',
+      [(root_comment_id, awarded_comment_id)])
+
+  @synchronized
+  def already_awarded_by_bot(self, awarding_comment):
+    return awarding_comment.id in self.awarding_comment_ids
 
+  @synchronized
   def fetch_awards_by_month(self, year, month):
     next_month = (month + 1) if (month < 12) else 1
     next_year = year if (next_month > 1) else (year + 1)
@@ -68,6 +336,19 @@ class DatabaseManager():
     return [dict(award) for award in awards]
 
 
+  @synchronized
+  def fetch_monthly_leaderboard(self, year, month):
+    """ Award counts per awardee for the month, in order of each awardee's
+    first award that month """
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('''SELECT awardee, num_awards, earliest_award_time
+        FROM monthly_leaderboard WHERE year = ? AND month = ? ORDER BY rowid''',
+        (year, month))
+      rows = cur.fetchall()
+    return [dict(row) for row in rows]
+
+  @synchronized
   def fetch_awards_by_awardee(self, awardee):
       with self.db:
           cur = self.db.cursor()
@@ -76,30 +357,155 @@ class DatabaseManager():
           awards = cur.fetchall()
       return [dict(award) for award in awards]
 
-  def log_dispo(self, comment, dispo, reply):
-    with self.db as conn:
-      conn.execute('''INSERT OR REPLACE INTO dispo_log 
-        (comment_id, dispo, reply_id, comment_time) 
-        VALUES (?, ?, ?, ?)''',
-        (comment.id, dispo, reply.id, comment.created_utc))
+  @synchronized
+  def log_dispo(self, comment, dispo, reply, next_rescan_time=None):
+    self.write('''INSERT OR REPLACE INTO dispo_log 
+      (comment_id, dispo, reply_id, comment_time, next_rescan_time) 
+      VALUES (?, ?, ?, ?, ?)''',
+      [(comment.id, dispo, reply.id, comment.created_utc, next_rescan_time)])
+    self.logged_comment_ids.add(comment.id)
 
+  @synchronized
   def fetch_dispo_log_by_comment(self, comment):
+    if comment.id not in self.logged_comment_ids:
+      return None
     with self.db:
       cur = self.db.cursor()
       cur.execute('SELECT * FROM dispo_log WHERE comment_id = ?', (comment.id,))
       row = cur.fetchone()
     return dict(row) if row else None
 
-  def fetch_recent_dispo_logs(self, days):
+  @synchronized
+  def delete_dispo_log(self, comment):
+    self.write('DELETE FROM dispo_log WHERE comment_id = ?', [(comment.id,)])
+    self.logged_comment_ids.discard(comment.id)
+
+  @synchronized
+  def fetch_state(self, key, default=None):
     with self.db:
       cur = self.db.cursor()
-      cur.execute('SELECT * FROM dispo_log WHERE comment_time > ?', 
-        (datetime.timestamp(datetime.utcnow() - timedelta(days=days)),))
+      cur.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+      row = cur.fetchone()
+    return row['value'] if row else default
+
+  @synchronized
+  def set_state(self, key, value):
+    with self.db as conn:
+      conn.execute('INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)',
+        (key, value))
+
+  @synchronized
+  def fetch_flair(self, user):
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('SELECT * FROM flair_mirror WHERE user = ?', (user,))
+      row = cur.fetchone()
+    return dict(row) if row else None
+
+  @synchronized
+  def fetch_all_flair(self):
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('SELECT * FROM flair_mirror ORDER BY rowid')
       rows = cur.fetchall()
     return [dict(row) for row in rows]
 
-  def delete_dispo_log(self, comment):
+  @synchronized
+  def update_flair(self, flairs):
+    with self.db as conn:
+      conn.executemany('''INSERT OR REPLACE INTO flair_mirror
+        (user, flair_text, flair_css_class) VALUES (:user, :flair_text, :flair_css_class)''',
+        flairs)
+
+  @synchronized
+  def replace_flair(self, flairs):
+    """ Replaces the whole flair mirror, e.g. with a fresh flair list """
+    with self.db as conn:
+      conn.execute('DELETE FROM flair_mirror')
+      conn.executemany('''INSERT INTO flair_mirror
+        (user, flair_text, flair_css_class) VALUES (:user, :flair_text, :flair_css_class)''',
+        flairs)
+
+  @synchronized
+  def enqueue_jobs(self, jobs):
+    self.write(ENQUEUE_JOB, jobs)
+
+  @synchronized
+  def fetch_due_jobs(self, now):
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('''SELECT * FROM update_jobs WHERE due_time <= ?
+        ORDER BY due_time''', (now,))
+      rows = cur.fetchall()
+    return [dict(row) for row in rows]
+
+  @synchronized
+  def fetch_next_job_time(self):
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('SELECT MIN(due_time) FROM update_jobs')
+      row = cur.fetchone()
+    return row[0]
+
+  @synchronized
+  def complete_job(self, job, next_due_time):
+    """ Deletes a job that has run, unless its target changed again while it
+    was running, in which case the job is pushed back to next_due_time with
+    its failed attempts forgotten """
+    with self.db as conn:
+      cur = conn.execute('DELETE FROM update_jobs WHERE target = ? AND version = ?',
+        (job['target'], job['version']))
+      if not cur.rowcount:
+        conn.execute('UPDATE update_jobs SET due_time = ?, attempts = 0 WHERE target = ?',
+          (next_due_time, job['target']))
+    return bool(cur.rowcount)
+
+  @synchronized
+  def reschedule_job(self, job, due_time):
+    """ Pushes back a job that failed and counts the failed attempt """
+    with self.db as conn:
+      conn.execute('''UPDATE update_jobs SET due_time = ?, attempts = attempts + 1
+        WHERE target = ?''', (due_time, job['target']))
+
+  @synchronized
+  def fetch_checkpoint(self, name):
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('SELECT * FROM scan_checkpoints WHERE name = ?', (name,))
+      row = cur.fetchone()
+    if row is None:
+      return None
+    return {'high_water_mark': row['high_water_mark'], 'recent': json.loads(row['recent'])}
+
+  @synchronized
+  def save_checkpoint(self, name, high_water_mark, recent):
+    self.write('''INSERT OR REPLACE INTO scan_checkpoints (name, high_water_mark, recent)
+      VALUES (?, ?, ?)''', [(name, high_water_mark, json.dumps(list(recent)))])
+
+  @synchronized
+  def delete_checkpoint(self, name):
     with self.db as conn:
-        conn.execute('DELETE FROM dispo_log WHERE comment_id = ?', (comment.id,))
+      conn.execute('DELETE FROM scan_checkpoints WHERE name = ?', (name,))
+
+  @synchronized
+  def fetch_due_rescans(self, now, since, limit):
+    """ Dispo logs due for a rescan, for comments made after since """
+    with self.db:
+      cur = self.db.cursor()
+      cur.execute('''SELECT * FROM dispo_log WHERE next_rescan_time <= ?
+        AND comment_time > ? ORDER BY next_rescan_time LIMIT ?''', (now, since, limit))
+      rows = cur.fetchall()
+    return [dict(row) for row in rows]
 
+  @synchronized
+  def postpone_rescan(self, comment_id, next_rescan_time):
+    self.write('''UPDATE dispo_log SET next_rescan_time = ?,
+      rescan_attempts = rescan_attempts + 1 WHERE comment_id = ?''',
+      [(next_rescan_time, comment_id)])
 
+  @synchronized
+  def expire_rescans(self, before):
+    """ Stops rescanning comments made before the given time """
+    with self.db as conn:
+      conn.execute('''UPDATE dispo_log SET next_rescan_time = NULL
+        WHERE next_rescan_time IS NOT NULL AND comment_time <= ?''', (before,))
@@ -32,13 +32,19 @@ import time
 import praw
 import logging
 import calendar
+import hashlib
+import zlib
+import json
 from datetime import datetime, timedelta
 import traceback
 import collections
+import heapq
 import random
+import threading
 from requests.exceptions import HTTPError
 import sqlite3 as lite
 import jinja2
+import jinja2.meta
 from operator import itemgetter
 
 try:
@@ -47,6 +53,12 @@ except ImportError:  # Python 3
     from html.parser import HTMLParser
 
 import db
+import cache
+import flair
+import metrics
+import checkpoint
+import scheduler
+from scheduler import REPLY, INBOX, FLAIR, WIKI
 
 dispos = {
     'confirmed': 0,
@@ -60,38 +72,54 @@ dispos = {
     'already_awarded_in_this_tree': 8
 }
 
+dispo_codes = {dispo: code for code, dispo in dispos.items()}
+
 rescannable_dispos = dispos['too_little_text'],
 trivial_dispos = (dispos['comment_author_is_me'], 
                   dispos['comment_does_not_contain_token'])
 
 logging.getLogger('requests').setLevel(logging.INFO)
 
-def skippable_line(line):
-    """ Returns true if the given line is a quote or code """
-    return re.search('(^    |^ *&gt;)', line) is not None
-
-def str_contains_token(text, tokens):
-    """ Returns true if a given string contains one of the given tokens, as long
-    as the token is not inside a quote or code block """
-    lines = text.split('\n')
-    in_quote = False
-    for line in lines:
-        if not line:  # Empty string
-            in_quote = False
-        if in_quote:
-            continue
-        if not skippable_line(line):
-            for token in tokens:
-                if token in line:
-                    return True
-        else:
-            in_quote = True
-    return False
-
-def write_saved_id(filename, the_id):
-    """ Write the previous comment's ID to file. """
-    with open(filename, 'w') as _file:
-        _file.write(the_id if the_id else "None")
+class TokenMatcher(object):
+    """ Finds award tokens that are not inside a quote or code block. A block
+    starts on a line beginning with four spaces or '&gt;' and runs until the
+    next empty line, so a token is quoted exactly when its paragraph has a
+    block-starting line at or above the token's line. Both patterns are
+    compiled once per token list and the body is scanned left to right,
+    jumping over the rest of any paragraph that turns out to be quoted. """
+
+    skippable_line = re.compile(r'^(?: {4}| *&gt;)', re.MULTILINE)
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens or [])
+        # Tokens are matched line by line, so one spanning a newline could
+        # never match and is left out of the pattern.
+        alternatives = sorted(set(re.escape(token) for token in self.tokens
+            if token and '\n' not in token), key=len, reverse=True)
+        self.pattern = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def contains_token(self, text):
+        """ Returns true if the text contains one of the tokens outside of a
+        quote or code block """
+        if self.pattern is None:
+            return False
+        pos = 0
+        while True:
+            match = self.pattern.search(text, pos)
+            if match is None:
+                return False
+            paragraph_start = text.rfind('\n\n', 0, match.start()) + 2
+            if paragraph_start == 1:  # No empty line before the token
+                paragraph_start = 0
+            line_end = text.find('\n', match.end())
+            if line_end == -1:
+                line_end = len(text)
+            if not self.skippable_line.search(text, paragraph_start, line_end):
+                return True
+            paragraph_end = text.find('\n\n', line_end)
+            if paragraph_end == -1:
+                return False
+            pos = paragraph_end
 
 def read_saved_id(filename):
     """ Get the last comment's ID from file. """
@@ -114,19 +142,133 @@ def get_longest_token_length(tokens):
         return 0
     return len(max(tokens, key=lambda t: len(t)))
 
-def load_templates(path):
-    templates = {}
-    root, dirs, fns = next(os.walk(path))
-    for fn in fns:
-        with open(os.path.join(path, fn), 'r', encoding='utf-8') as f:
-            templates[os.path.splitext(fn)[0]] = jinja2.Template(f.read())
-    for d in dirs:
-        templates[d] = load_templates(os.path.join(path, d))
-    return templates
+def chunks(iterable, size):
+    """ Yields successive lists of up to size items from an iterable """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def shard_of(submission_id, num_shards):
+    """ The shard a submission belongs to in sharded mode, the same in every
+    process """
+    return zlib.crc32(submission_id.encode('utf-8')) % num_shards
+
+def reddit_client(config):
+    """ Creates the PRAW session, talking to reddit_url instead of the
+    praw.ini site's domains when it is set, e.g. to a fake_reddit server """
+    reddit = praw.Reddit(config.subreddit + ' bot', site_name=config.site_name)
+    if config.reddit_url:
+        reddit.config.api_url = config.reddit_url
+        reddit.config.permalink_url = config.reddit_url
+        reddit.config.oauth_url = config.reddit_url
+    return reddit
+
+def update_job(target, kind, due_time, **args):
+    """ A row for DatabaseManager.enqueue_jobs. Jobs with the same target
+    are coalesced, so the target names the page or flair the job rebuilds. """
+    return {'target': target, 'kind': kind, 'args': json.dumps(args),
+            'due_time': due_time}
+
+class UserAwards(object):
+    """
+    One user's awards grouped by awarded comment, in the shape the user wiki
+    page template renders. Groups are kept in order of their first award and
+    each group's awarding comments in time order, so adding an award touches
+    only the group it belongs to. The async engine adds awards from its reply
+    thread while the update thread renders them, so renders use snapshot().
+    """
+
+    def __init__(self, awardee, awards=()):
+        self.awardee = awardee
+        self.num_awards = 0
+        self.awarded_comments = collections.OrderedDict()
+        self.lock = threading.Lock()
+        for award in awards:
+            self.add(award)
+
+    def add(self, award):
+        with self.lock:
+            awarded_comment = self.awarded_comments.get(award['awarded_comment_id'])
+            if awarded_comment is None:
+                awarded_comment = {key: value for key, value in award.items()
+                    if 'awarding' not in key}
+                awarded_comment['awarding_comments'] = []
+                self.awarded_comments[award['awarded_comment_id']] = awarded_comment
+            awarding_comments = awarded_comment['awarding_comments']
+            awarding_comments.append({key.replace('awarding_comment_', ''): value
+                for key, value in award.items() if 'awarding' in key})
+            if len(awarding_comments) > 1 and \
+                    awarding_comments[-2]['time'] > awarding_comments[-1]['time']:
+                awarding_comments.sort(key=lambda x: x['time'])
+            self.num_awards += 1
+
+    def snapshot(self):
+        """ Returns the number of awards and a copy of the awarded comments
+        that later calls to add() leave alone """
+        with self.lock:
+            return self.num_awards, [dict(awarded_comment,
+                awarding_comments=list(awarded_comment['awarding_comments']))
+                for awarded_comment in self.awarded_comments.values()]
+
+class TemplateDirectory(object):
+    """
+    The templates in a directory, looked up by file name without extension,
+    with subdirectories as nested TemplateDirectory objects. Templates are
+    compiled by a shared jinja2 Environment on first use, and its bytecode
+    cache keeps the compiled code on disk between runs.
+    """
+
+    def __init__(self, environment, root, prefix=''):
+        self.environment = environment
+        self.files = {}
+        self.subdirectories = {}
+        self.variables_by_name = {}
+        _, dirs, fns = next(os.walk(os.path.join(root, prefix)))
+        for fn in fns:
+            self.files[os.path.splitext(fn)[0]] = prefix + fn
+        for d in dirs:
+            self.subdirectories[d] = TemplateDirectory(environment, root, prefix + d + '/')
+
+    def __getitem__(self, name):
+        if name in self.subdirectories:
+            return self.subdirectories[name]
+        return self.environment.get_template(self.files[name])
+
+    def __contains__(self, name):
+        return name in self.files or name in self.subdirectories
+
+    def variables(self, name):
+        """ The names a template takes from its render context """
+        if name not in self.variables_by_name:
+            source = self.environment.loader.get_source(self.environment,
+                self.files[name])[0]
+            self.variables_by_name[name] = jinja2.meta.find_undeclared_variables(
+                self.environment.parse(source))
+        return self.variables_by_name[name]
+
+def load_templates(path, cache_dir=None):
+    """ Templates are cached in the system temp directory unless cache_dir
+    is given """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(path, encoding='utf-8'),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir))
+    return TemplateDirectory(environment, path)
 
 class DeltaBot(object):
-    def __init__(self, config, reddit):
+    def __init__(self, config, reddit, database=None, shard=None, stop=None):
+        """ shard is (index, number of shards) for a worker in sharded
+        mode, whose database is then a sharding.RemoteDatabase, and stop an
+        Event the workers share that ends their main loops when set """
         self.config = config
+        self.shard = shard
+        self.stop = stop
         self.running = False
         self.reddit = reddit
 
@@ -135,38 +277,196 @@ class DeltaBot(object):
         logging.info("Logged in as %s" % self.config.account['username'])
 
         self.subreddit = self.reddit.get_subreddit(self.config.subreddit)
+        self.scheduler = scheduler.RequestScheduler.from_config(self.config)
+        self.poll_interval = scheduler.AdaptivePollInterval.from_config(self.config)
+        self.metrics = metrics.Metrics()
 
-        self.scanned_comments = collections.deque([], 10)
-
-        most_recent_comment_id = read_saved_id(self.config.last_comment_filename)
-
-        if most_recent_comment_id is not None:
-            self.scanned_comments.append(most_recent_comment_id)
-
+        self.token_matcher = TokenMatcher(self.config.tokens)
         self.minimum_comment_length = get_longest_token_length(self.config.tokens) + self.config.minimum_comment_length
-        self.db = db.DatabaseManager(self.config.database)
-        self.templates = load_templates('./config/templates')
-
-        self.awarded_comments = []
-
-    def climb_up(self, comment):
-        if comment.is_root:
-            return comment
-        else:
-            parent = self.reddit.get_info(thing_id=comment.parent_id)
-            return self.climb_up(parent)
+        self.db = database if database is not None else \
+            db.DatabaseManager(self.config.database)
+        self.checkpoint_name = 'comments' if shard is None else 'comments/%d' % shard[0]
+        self.checkpoint = self.load_checkpoint()
+        self.checkpoint_resets = 0
+        # shard 0 counts its resets in the database for the others to follow
+        self.reset_generation = self.db.fetch_state('checkpoint_reset') \
+            if shard is not None else None
+        self.templates = load_templates('./config/templates', self.config.template_cache_dir)
+        # reply text that doesn't depend on the comment, by dispo
+        self.static_replies = {}
+
+        self.update_debounce_window = self.config.update_debounce_window or 300
+        # other shards award points too, so shards can't cache awards
+        self.user_awards = cache.LRUDict(
+            0 if shard else self.config.user_awards_cache_size or 1000)
+        self.parents = {}
+        self.moderators = cache.ExpiringValue(self.fetch_moderator_names,
+            self.config.moderator_cache_ttl or 300)
+        self.ancestors = cache.AncestorCache(self.fetch_parent_id,
+            self.config.ancestor_cache_size or 10000)
+        self.flair_mirror = flair.FlairMirror(self.db, self.subreddit,
+            self.config.flair_reconcile_interval or 24 * 60 * 60, self.request)
+        self.metrics.add_counter('deltabot_api_requests_total', 'api_calls',
+            "Reddit API calls, by PRAW method.", 'endpoint', self.scheduler.endpoint_calls)
+        self.metrics.add_counter('deltabot_db_calls_total', 'db_calls',
+            "DatabaseManager calls, by method.", 'method', self.db.method_calls)
+        self.metrics_server = None
+        if self.config.metrics_port:
+            # shard n serves its metrics on metrics_port + n
+            port = self.config.metrics_port + (shard[0] if shard else 0)
+            self.metrics_server = metrics.serve(self.metrics, port)
+        if self.is_primary():
+            self.flair_mirror.reconcile_if_due()
+
+    def is_primary(self):
+        """ Whether this bot handles the inbox, rescans and update jobs,
+        which in sharded mode only shard 0 does """
+        return self.shard is None or self.shard[0] == 0
+
+    def owns(self, comment):
+        """ Whether this bot handles the comment's submission """
+        return self.shard is None or \
+            shard_of(comment.link_id[3:], self.shard[1]) == self.shard[0]
+
+    def load_checkpoint(self):
+        """ Loads the scan checkpoint, starting it from the comment id in
+        last_comment_filename, where older versions kept their place, if
+        there isn't one yet """
+        window = self.config.checkpoint_window or 100
+        saved = self.db.fetch_checkpoint(self.checkpoint_name)
+        if saved is not None:
+            return checkpoint.ScanCheckpoint(saved['high_water_mark'], saved['recent'], window)
+        scan_checkpoint = checkpoint.ScanCheckpoint(window=window)
+        last_comment_id = read_saved_id(self.config.last_comment_filename) \
+            if self.config.last_comment_filename else None
+        if last_comment_id:
+            logging.info("Starting the scan checkpoint at %s from %s" % (
+                last_comment_id, self.config.last_comment_filename))
+            scan_checkpoint.advance([last_comment_id])
+            self.db.save_checkpoint(self.checkpoint_name, scan_checkpoint.high_water_mark,
+                scan_checkpoint.recent)
+        return scan_checkpoint
+
+    def save_checkpoint(self):
+        self.db.save_checkpoint(self.checkpoint_name, self.checkpoint.high_water_mark,
+            self.checkpoint.recent)
+
+    def reset_checkpoint(self):
+        """ Forgets which comments have been scanned. In sharded mode shard 0
+        resets every shard's checkpoint; the other shards also clear the one
+        they hold when they next call follow_checkpoint_reset. """
+        self.checkpoint.clear()
+        self.db.delete_checkpoint(self.checkpoint_name)
+        self.checkpoint_resets += 1
+        if self.shard is not None and self.is_primary():
+            for shard in range(1, self.shard[1]):
+                self.db.delete_checkpoint('comments/%d' % shard)
+            self.reset_generation = str(int(self.reset_generation or 0) + 1)
+            self.db.set_state('checkpoint_reset', self.reset_generation)
+
+    def follow_checkpoint_reset(self):
+        """ Resets this shard's checkpoint if shard 0 has reset it since """
+        generation = self.db.fetch_state('checkpoint_reset')
+        if generation != self.reset_generation:
+            logging.info("Resetting the scan checkpoint along with shard 0")
+            self.reset_checkpoint()
+            self.reset_generation = generation
+
+    def request(self, priority, fn, *args, **kwargs):
+        """ Makes a reddit API call through the request scheduler """
+        return self.scheduler.call(priority, fn, *args, **kwargs)
+
+    def prefetch_parents(self, comments):
+        """ Resolves the parents of every token-bearing comment in bulk so
+        that dispo_comment doesn't need a round trip per comment """
+        parent_ids = set(comment.parent_id for comment in comments
+            if self.token_matcher.contains_token(comment.body))
+        parent_ids.difference_update(self.parents)
+        for id_chunk in chunks(sorted(parent_ids), 100):
+            for thing in self.request(REPLY, self.reddit.get_info, thing_id=id_chunk) or []:
+                self.parents[thing.name] = thing
+
+    def get_parent(self, comment):
+        """ Returns the comment's parent, from the prefetched map if possible """
+        parent = self.parents.get(comment.parent_id)
+        if parent is None:
+            parent = self.request(REPLY, self.reddit.get_info, thing_id=comment.parent_id)
+            if parent is not None:
+                self.parents[comment.parent_id] = parent
+        return parent
+
+    def fetch_parent_id(self, name):
+        """ Looks up the parent_id of a comment by fullname """
+        thing = self.parents.get(name)
+        if thing is None:
+            thing = self.request(REPLY, self.reddit.get_info, thing_id=name)
+        return thing.parent_id
+
+    def find_root_id(self, comment):
+        """ Returns the id of the root comment of the comment's tree """
+        return self.ancestors.root_of(comment.name, comment.parent_id)[3:]
+
+    def resolve_roots(self, names):
+        """ Returns the root comment fullname of each of the named comments
+        whose tree can be walked, fetching a level of every tree at a time
+        in bulk """
+        not_found = set()
+        while True:
+            unknown = set(self.ancestors.first_unknown(name) for name in names)
+            unknown.difference_update([None], not_found)
+            if not unknown:
+                break
+            for id_chunk in chunks(sorted(unknown), 100):
+                for thing in self.request(REPLY, self.reddit.get_info, thing_id=id_chunk) or []:
+                    self.ancestors.add(thing.name, thing.parent_id)
+            not_found.update(name for name in unknown if name not in self.ancestors.parents)
+        return dict((name, self.ancestors.root_of(name)) for name in names
+            if self.ancestors.first_unknown(name) is None)
+
+    def backfill_award_roots(self):
+        """ Fills in root_comment_id for a batch of the awards recorded before
+        it was stored; the main loop does a batch each iteration. Awards whose
+        root can't be found get an empty one so they aren't looked up again. """
+        batch_size = self.config.root_backfill_batch_size or 100
+        awarded_comment_ids = self.db.fetch_awarded_comments_missing_root(batch_size)
+        if not awarded_comment_ids:
+            return
+        logging.info("Backfilling root comment ids for %d awarded comments"
+            % len(awarded_comment_ids))
+        try:
+            roots = self.resolve_roots(['t1_' + awarded_comment_id
+                for awarded_comment_id in awarded_comment_ids])
+        except Exception:
+            logging.warning("Could not look up awarded comments' roots:\n%s"
+                % traceback.format_exc())
+            return
+        with self.db.unit_of_work():
+            for awarded_comment_id in awarded_comment_ids:
+                root = roots.get('t1_' + awarded_comment_id)
+                if root is None:
+                    logging.warning("Could not find the root of comment %s"
+                        % awarded_comment_id)
+                self.db.set_award_root(awarded_comment_id, root[3:] if root else '')
 
     def send_first_time_message(self, awardee):
-        first_time_message = self.templates['first_award_message'].render(awardee=awardee, config=self.config)
-        self.reddit.send_message(awardee,
-            self.config.private_message_subject_line, first_time_message)
+        with self.metrics.phase('messages'):
+            first_time_message = self.templates['first_award_message'].render(awardee=awardee, config=self.config)
+            self.request(FLAIR, self.reddit.send_message, awardee,
+                self.config.private_message_subject_line, first_time_message)
 
     def get_reply_text(self, comment, dispo, parent_comment=None):
         """ Replies to a comment with the type of message specified """
+        if dispo in self.static_replies:
+            return self.static_replies[dispo]
+        replies = self.templates['replies']
+        dispo_code = dispo_codes[dispo]
+        if replies.variables(dispo_code) <= {'config'}:
+            msg = replies[dispo_code].render(config=self.config)
+            self.static_replies[dispo] = msg
+            return msg
         if parent_comment is None:
-            parent_comment = self.reddit.get_info(thing_id=comment.parent_id)
-        dispo_code = next((k for k, v in dispos.items() if v == dispo), None)
-        msg = self.templates['replies'][dispo_code].render(comment=comment, 
+            parent_comment = self.get_parent(comment)
+        msg = replies[dispo_code].render(comment=comment, 
             parent_comment=parent_comment, config=self.config)
         return msg
 
@@ -179,26 +479,66 @@ class DeltaBot(object):
                 return True
         return False
 
-    def award_point(self, awarded_comment, awarding_comment):
-        """ Awards a point. """
+    def award_point(self, awarded_comment, awarding_comment, root_comment_id):
+        """ Awards a point. The root of the awarded comment's tree is looked
+        up by the caller, before the reply is posted. """
         logging.info("Awarding point to {}".format(awarded_comment.author.name))
-        self.db.award_point(awarded_comment, awarding_comment)
-        self.awarded_comments += awarded_comment
-
-    def update_monthly_scoreboard(self, year, month, awards):
+        awardee = awarded_comment.author.name
+        user_awards = self.get_user_awards(awardee)
+        award = self.db.award_point(awarded_comment, awarding_comment,
+            root_comment_id, self.award_update_jobs(awardee,
+                awarding_comment, first_award=(user_awards.num_awards == 0)))
+        user_awards.add(award)
+
+    def award_update_jobs(self, awardee, awarding_comment, first_award):
+        """ The updates an award makes necessary: the awardee's flair and wiki
+        page, the month's scoreboard, and the leaders' flair and the sidebar.
+        They come due after the debounce window, so a run of awards costs one
+        rebuild of each. """
+        now = time.time()
+        due_time = now + self.update_debounce_window
+        # the month the award is counted in by the monthly leaderboard
+        awarded_at = datetime.fromtimestamp(awarding_comment.created_utc)
+        jobs = [
+            update_job('user/' + awardee, 'awardee', due_time, awardee=awardee),
+            update_job('scoreboard/%d/%d' % (awarded_at.year, awarded_at.month),
+                'scoreboard', due_time, year=awarded_at.year, month=awarded_at.month),
+            update_job('leaders', 'leaders', due_time),
+        ]
+        if first_award:
+            jobs.append(update_job('first_award_message/' + awardee,
+                'first_award_message', now, awardee=awardee))
+        return jobs
+
+    def update_monthly_scoreboard(self, year, month, leaderboard):
         logging.info("Updating monthly scoreboard")
-        awardee_awards = {}
-        for awardee in set([award['awarded_comment_author'] for award in awards]):
-            awardee_awards[awardee] = [award for award in awards if award['awarded_comment_author'] == awardee]
-        new_content = self.templates['monthly_scoreboard'].render(awardee_awards=awardee_awards)
+        leaders = sorted(leaderboard, key=lambda x: x['num_awards'], reverse=True)
+        new_content = self.templates['monthly_scoreboard'].render(leaders=leaders,
+            config=self.config)
         page_title = "scoreboard_%s_%s" % (year, month)
-        self.reddit.edit_wiki_page(self.config.subreddit, page_title,
-            new_content, "Updating monthly scoreboard")
+        self.edit_wiki_page(page_title, new_content, "Updating monthly scoreboard")
+
+    def publish_if_changed(self, target, content, publish):
+        """ Calls publish unless content is identical to what was last
+        published to the target, going by a stored hash """
+        key = 'content_hash:' + target
+        content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        if self.db.fetch_state(key) == content_hash:
+            logging.info("Skipping unchanged %s" % target)
+            return False
+        publish()
+        self.db.set_state(key, content_hash)
+        return True
+
+    def edit_wiki_page(self, page, content, reason):
+        return self.publish_if_changed('wiki/' + page, content,
+            lambda: self.request(WIKI, self.reddit.edit_wiki_page,
+                self.config.subreddit, page, content, reason))
 
     def adjust_point_flair(self, awardee, num):
         """ Update flair. """
         css_class = self.config.flair['css_class']
-        current_flair = self.subreddit.get_flair(awardee)
+        current_flair = self.flair_mirror.get(awardee)
         if current_flair['flair_css_class']:
             if self.config.flair['css_class'] not in current_flair['flair_css_class']:
                 css_class = " ".join(filter(None, 
@@ -207,58 +547,29 @@ class DeltaBot(object):
         else:
             css_class = self.config.flair['css_class']
 
-        self.subreddit.set_flair(awardee, self.config.flair['point_text'] % num, css_class)
-
-    def get_most_recent_comment(self):
-        """Finds the most recently scanned comment,
-        so we know where to begin the next scan"""
-
-        most_recent_comment_id = None
-        while self.scanned_comments:
-            comment = self.reddit.get_info(thing_id=self.scanned_comments[-1])
-            if comment is not None:
-                if comment.body == '[deleted]':
-                    self.scanned_comments.pop()
-                else:
-                    most_recent_comment_id = self.scanned_comments[-1]
-                    break
-            else:
-                most_recent_comment_id = self.scanned_comments[-1]
-                break
-
-        return most_recent_comment_id
+        self.flair_mirror.set([flair.flair_row(awardee,
+            self.config.flair['point_text'] % num, css_class)])
 
     def already_awarded_in_this_tree(self, awarding_comment, awarded_comment=None):
         if awarded_comment is None:
-            awarded_comment = self.reddit.get_info(thing_id=awarding_comment.parent_id)
+            awarded_comment = self.get_parent(awarding_comment)
 
-        # first see if there's already a record of an award being given
-        previous_awards = self.db.previous_awards_in_submission(awarded_comment, awarding_comment)
-
-        # if nothing was found, then we're good to go
-        if not previous_awards:
-            return False
-
-        # otherwise, check if the any of the previous awards come from the same root comment.
-        else:
-            awarded_comment_root = self.climb_up(awarded_comment)
-            for previous_award in previous_awards:
-                previous_awarding_comment = self.reddit.get_info(
-                    thing_id='t1_'+previous_award['awarding_comment_id'])
-                if self.climb_up(previous_awarding_comment).id == awarded_comment_root.id:
-                    return True
-        return False
+        # look for a previous award between the same two users under the
+        # same root comment; roots are stored with each award
+        previous_awards = self.db.previous_awards_in_submission(awarded_comment,
+            awarding_comment, self.find_root_id(awarded_comment))
+        return bool(previous_awards)
 
     def already_awarded_by_bot(self, comment):
         return self.db.already_awarded_by_bot(comment)
 
     def dispo_comment(self, comment, strict=True):
-        if not str_contains_token(comment.body, self.config.tokens) and strict:
+        if not self.token_matcher.contains_token(comment.body) and strict:
             logging.info('String does not contain an award token')
             dispo = dispos['comment_does_not_contain_token']
             parent = None
         else:
-            parent = self.reddit.get_info(thing_id=comment.parent_id)
+            parent = self.get_parent(comment)
             parent_author = parent.author.name
             comment_author = comment.author.name
             me = self.config.account['username']
@@ -296,6 +607,7 @@ class DeltaBot(object):
                 logging.info("Comment meets criteria for awarding a point")
                 dispo = dispos['confirmed']
 
+        self.metrics.count_dispo(dispo_codes[dispo])
         return dispo, parent
 
     def process_comment(self, comment, strict=True):
@@ -303,53 +615,119 @@ class DeltaBot(object):
             comment.permalink, comment.author.name))
 
         dispo, parent = self.dispo_comment(comment, strict)
-
+        self.apply_dispo(comment, dispo, parent)
+
+    def apply_dispo(self, comment, dispo, parent):
+        """ Replies to, edits or deletes the bot's reply to a comment to match
+        its dispo, and awards the point if it is confirmed """
+        # a point can only be recorded along with the root of the awarded
+        # comment's tree, so find it before anything is posted; if it can't
+        # be found the comment is left to be processed again
+        root_id = self.find_root_id(parent) if dispo == dispos['confirmed'] else None
         prev_dispo_log = self.db.fetch_dispo_log_by_comment(comment)
         if not prev_dispo_log:
             if dispo not in trivial_dispos:
-                reply = comment.reply(self.get_reply_text(comment, dispo, parent))
-                reply.distinguish()
-                self.db.log_dispo(comment, dispo, reply)
+                reply = self.request(REPLY, comment.reply,
+                    self.get_reply_text(comment, dispo, parent))
+                self.db.log_dispo(comment, dispo, reply, self.next_rescan_time(dispo))
                 if dispo == dispos['confirmed']:
-                    self.award_point(parent, comment)
+                    self.award_point(parent, comment, root_id)
+                # the reply is committed before anything else can fail
+                self.db.flush()
+                self.request(REPLY, reply.distinguish)
         else:
             if dispo != prev_dispo_log['dispo']:
-                bots_reply = self.reddit.get_info(
+                bots_reply = self.request(REPLY, self.reddit.get_info,
                     thing_id=('t1_'+prev_dispo_log['reply_id']))
                 if dispo in trivial_dispos:
-                    bots_reply.delete()
+                    self.request(REPLY, bots_reply.delete)
                     self.db.delete_dispo_log(comment)
+                elif dispo == dispos['already_awarded_by_bot']:
+                    # the reply is left as it is, but a rescan would only
+                    # come back to this comment again and again
+                    self.db.postpone_rescan(comment.id, None)
                 else:
-                    if dispo != dispos['already_awarded_by_bot']:
-                        bots_reply.edit(self.get_reply_text(comment, dispo, parent))
-                        self.db.log_dispo(comment, dispo, bots_reply)
-                        if dispo == dispos['confirmed']:
-                            self.award_point(parent, comment)            
-        
+                    self.request(REPLY, bots_reply.edit,
+                        self.get_reply_text(comment, dispo, parent))
+                    self.db.log_dispo(comment, dispo, bots_reply,
+                        self.next_rescan_time(dispo))
+                    if dispo == dispos['confirmed']:
+                        self.award_point(parent, comment, root_id)
+        # Commit point: the writes that go with a reply are committed as soon
+        # as it is posted, rather than with the rest of the scan batch
+        self.db.flush()
+
+    def fresh_comments(self, scan_checkpoint):
+        """ Returns the comments the checkpoint hasn't seen, oldest first.
+        The listing is newest first, so it is paged back until it reaches
+        comments the checkpoint is past. """
+        listing = self.subreddit.get_comments(limit=None)
+        fresh = []
+        pages = self.scheduler.iterate(REPLY, chunks(listing, 100), endpoint='get_comments')
+        for page in pages:
+            fresh.extend(comment for comment in page if scan_checkpoint.is_new(comment.name))
+            if any(scan_checkpoint.is_behind(comment.name) for comment in page):
+                break
+        fresh.sort(key=lambda comment: checkpoint.fullname_key(comment.name))
+        return fresh
+
     def scan_comments(self):
         """ Pull the most recent comments and search them for award tokens. If a token is found,
-        award points. """
+        award points. Returns the number of new comments. """
         logging.info("Scanning new comments")
 
-        fresh_comments = self.subreddit.get_comments(
-            params={'before': self.get_most_recent_comment()}, limit=None)
-
-        for comment in fresh_comments:
-            self.process_comment(comment)
-            if (not self.scanned_comments) or (comment.name > self.scanned_comments[-1]):
-                self.scanned_comments.append(comment.name)
+        self.parents.clear()
+        fresh_comments = self.fresh_comments(self.checkpoint)
+        for page in chunks(fresh_comments, 100):
+            # the checkpoint covers comments that belong to other shards too
+            owned = [comment for comment in page if self.owns(comment)]
+            self.prefetch_parents(owned)
+            # the page's writes are committed along with the checkpoint
+            with self.db.unit_of_work():
+                for comment in owned:
+                    self.process_comment(comment)
+                self.checkpoint.advance(comment.name for comment in page)
+                self.save_checkpoint()
+        return len(fresh_comments)
+
+    def next_rescan_time(self, dispo, attempts=0):
+        """ When a comment with the given dispo should next be rescanned, None
+        if it shouldn't be. The delay doubles with every rescan that finds
+        the comment unchanged, up to rescan_max_interval. """
+        if dispo not in rescannable_dispos:
+            return None
+        delay = (self.config.rescan_interval or 600) * 2 ** attempts
+        return time.time() + min(delay, self.config.rescan_max_interval or 24 * 60 * 60)
 
     def rescan_comments(self):
-        """Rescan comments with rescannable dispos"""
-        logging.info("Rescanning comments")
-
-        recent_logs = self.db.fetch_recent_dispo_logs(self.config.days_to_rescan)
-        rescannable_logs = [log for log in recent_logs 
-            if log['dispo'] in rescannable_dispos]
-
-        for log in rescannable_logs:
-            comment = self.reddit.get_info(thing_id='t1_'+log['comment_id'])
-            self.process_comment(comment, log)
+        """Rescan the comments with rescannable dispos that are due"""
+        now = time.time()
+        since = now - self.config.days_to_rescan * 24 * 60 * 60
+        self.db.expire_rescans(since)
+        due_logs = self.db.fetch_due_rescans(now, since,
+            self.config.rescan_batch_size or 500)
+        if not due_logs:
+            return
+        logging.info("Rescanning %d comments" % len(due_logs))
+
+        for log_chunk in chunks(due_logs, 100):
+            things = self.request(REPLY, self.reddit.get_info,
+                thing_id=['t1_' + log['comment_id'] for log in log_chunk]) or []
+            comments = {thing.name: thing for thing in things}
+            self.prefetch_parents(comments.values())
+            with self.db.unit_of_work():
+                for log in log_chunk:
+                    comment = comments.get('t1_' + log['comment_id'])
+                    dispo = None
+                    if comment is not None:
+                        logging.info("Rescanning comment {} by {}".format(
+                            comment.permalink, comment.author.name))
+                        dispo, parent = self.dispo_comment(comment)
+                    if dispo is None or dispo == log['dispo']:
+                        self.db.postpone_rescan(log['comment_id'], self.next_rescan_time(
+                            log['dispo'], log['rescan_attempts'] + 1))
+                    else:
+                        self.apply_dispo(comment, dispo, parent)
 
     def extract_comment_ids(self, message_body):
         comment_id_regex = ('(?:http://)?(?:www\.)?reddit\.com/r(?:eddit)?/' +
@@ -359,14 +737,17 @@ class DeltaBot(object):
     def command_rescan(self, message_body, strict=True):
         comment_ids = self.extract_comment_ids(message_body)
         for comment_id in comment_ids:
-            comment = self.reddit.get_info(thing_id='t1_'+comment_id)
+            comment = self.request(INBOX, self.reddit.get_info, thing_id='t1_'+comment_id)
             if type(comment) is praw.objects.Comment:
                 self.process_comment(comment, strict=strict)
 
+    def fetch_moderator_names(self):
+        moderators = self.request(INBOX, self.reddit.get_moderators,
+            self.config.subreddit)
+        return frozenset(mod.name for mod in moderators)
+
     def is_moderator(self, name):
-        moderators = self.reddit.get_moderators(self.config.subreddit)
-        mod_names = [mod.name for mod in moderators]
-        return name in mod_names
+        return name in self.moderators.get()
 
     def scan_message(self, message):
         logging.info("Scanning message {} from {}".format(
@@ -375,15 +756,16 @@ class DeltaBot(object):
         if self.is_moderator(message.author.name):
             command = message.subject.lower()
             if command == "force add":
-                self.reddit.send_message("/r/" + self.config.subreddit,
-                    "Force Add Detected", 
+                self.request(INBOX, self.reddit.send_message,
+                    "/r/" + self.config.subreddit, "Force Add Detected",
                     ("The Force Add command has been used on the following link(s):\n\n" +
                     message.body))
 
             if command == "add" or command == "force add":
                 strict = (command != "force add")
                 self.command_rescan(message.body, strict=strict)
-                self.reddit.send_message(message.author, "Add complete",
+                self.request(INBOX, self.reddit.send_message, message.author,
+                    "Add complete",
                     "The add command has been completed on: " + message.body)
 
             elif command == "remove":
@@ -394,17 +776,21 @@ class DeltaBot(object):
                 self.command_rescan(message.body)
 
             elif command == "reset":
-                self.scanned_comments.clear()
+                self.reset_checkpoint()
+
+            elif command == "reload mods":
+                self.moderators.invalidate()
 
             elif command == "stop":
-                self.reddit.send_message("/r/" + self.config.subreddit,
-                                         "Stop Message Confirmed",
-                                         "NOTICE: The stop message has been "
-                                         "issued and I have stopped running.")
+                self.request(INBOX, self.reddit.send_message,
+                             "/r/" + self.config.subreddit,
+                             "Stop Message Confirmed",
+                             "NOTICE: The stop message has been "
+                             "issued and I have stopped running.")
                 logging.warning("The stop command has been issued. If this was "
                                 "not sent by you, please check as to why before"
                                 " restarting.")
-                message.mark_as_read()
+                self.request(INBOX, message.mark_as_read)
                 sys.exit(1)
 
     def scan_inbox(self):
@@ -412,7 +798,8 @@ class DeltaBot(object):
         then get newest comments from the inbox. """
         logging.info("Scanning inbox")
 
-        messages = self.reddit.get_unread(unset_has_mail=True)
+        messages = self.request(INBOX, list,
+            self.reddit.get_unread(unset_has_mail=True), endpoint='get_unread')
 
         for message in messages:
             kind = type(message)
@@ -421,7 +808,7 @@ class DeltaBot(object):
             elif kind == praw.objects.Message:
                 self.scan_message(message)
 
-            message.mark_as_read()
+            self.request(INBOX, message.mark_as_read)
 
     def scan_mod_mail(self):
         pass
@@ -429,15 +816,11 @@ class DeltaBot(object):
     def update_top_css(self, leaders):
         """ Update the flair css for the top ten users """
         logging.info("Updating flair css for top 10 users")
-        self.clear_leader_flair_css()
-        
-        for i, leader in enumerate(leaders):
-            flair = self.subreddit.get_flair(leader)
-            flair_text = flair['flair_text'] 
-            current_css = flair['flair_css_class']
-            new_class = self.config.flair['top1'] if (i == 0) else self.config.flair['top10']
-            new_css = ' '.join(filter(None, [current_css, new_class]))
-            self.subreddit.set_flair(leader, flair_text=flair_text, flair_css_class=new_css)
+        changes = flair.leader_flair_changes(self.flair_mirror.all(), leaders,
+            self.config.flair)
+        if changes:
+            logging.info("Setting flair for %d users" % len(changes))
+            self.flair_mirror.set(changes)
 
     def update_sidebar_scoreboard(self, leaders, month):
         """ Update the top 10 list with highest scores. """
@@ -445,121 +828,136 @@ class DeltaBot(object):
         score_table = self.templates['sidebar_scoreboard'].render(leaders=leaders, 
             month=month)
 
-        settings = self.subreddit.get_settings()
-        old_desc = settings['description']
-        # IMPORTANT: this splits the description on the _____ token.
-        # Don't use said token for anything other than dividing sections
-        # or else this breaks.
-        split_desc = old_desc.split("_____")
-        split_desc[-1] = score_table
-        new_desc = "_____".join(split_desc).replace('&amp;', '&')
-        self.subreddit.update_settings(description=new_desc)
-
-    def update_wiki_tracker(self, awardee, awards):
+        def publish():
+            settings = self.request(WIKI, self.subreddit.get_settings)
+            old_desc = settings['description']
+            # IMPORTANT: this splits the description on the _____ token.
+            # Don't use said token for anything other than dividing sections
+            # or else this breaks.
+            split_desc = old_desc.split("_____")
+            split_desc[-1] = score_table
+            new_desc = "_____".join(split_desc).replace('&amp;', '&')
+            self.request(WIKI, self.subreddit.update_settings, description=new_desc)
+
+        self.publish_if_changed('sidebar/scoreboard', score_table, publish)
+
+    def get_user_awards(self, awardee):
+        """ Returns the awardee's grouped awards, loading them from the
+        database only when they aren't cached """
+        user_awards = self.user_awards.get(awardee)
+        if user_awards is None:
+            user_awards = UserAwards(awardee, self.db.fetch_awards_by_awardee(awardee))
+            self.user_awards[awardee] = user_awards
+        return user_awards
+
+    def update_wiki_tracker(self, awardee, user_awards):
         """ Update the wiki tracker page for an individual """
         logging.info('Updating wiki page for user {}'.format(awardee))
-        # munge the raw awards data into a form suitable for rendering
-        awarded_comments = []
-        for awarded_comment_id in set([award['awarded_comment_id']
-                for award in awards]):
-            awards_for_comment = [award for award in awards if 
-                award['awarded_comment_id'] == awarded_comment_id]
-            awarded_comment = {key: awards_for_comment[0][key] for key in 
-                awards_for_comment[0].keys() if 'awarding' not in key}
-            awarded_comment['awarding_comments'] = [
-                {key.replace('awarding_comment_', ''): award_for_comment[key] 
-                for key in award_for_comment.keys() if 'awarding' in key} for 
-                award_for_comment in awards_for_comment]
-            awarded_comment['awarding_comments'].sort(key=lambda x: x['time'])
-            awarded_comments.append(awarded_comment)
-
-        new_content = self.templates['user_wiki_page'].render(awardee=awardee, 
-            num_awards=len(awards), awarded_comments=awarded_comments, dt=datetime)
-        self.reddit.edit_wiki_page(self.config.subreddit, "user/" + awardee, 
-            new_content, "Updated awards.")
-
-    def find_top_n(self, awards, n):
-
-        def find_earliest_award(awardee):
-            awardee_awards = [award for award in awards if 
-                award['awarded_comment_author'] == awardee]
-            awardee_awards.sort(key=lambda x: x['awarded_comment_time'])
-            return awardee_awards[0]['awarded_comment_time']
-
-        top_awardees = collections.Counter([award['awarded_comment_author'] 
-            for award in awards]).most_common(n)
-        tops = [
-            {'awardee': awardee[0], 
-             'num_awards': awardee[1], 
-             'earliest_award_time': find_earliest_award(awardee[0])} 
-            for awardee in top_awardees]
+        num_awards, awarded_comments = user_awards.snapshot()
+        new_content = ''.join(self.templates['user_wiki_page'].generate(
+            awardee=awardee, num_awards=num_awards,
+            awarded_comments=awarded_comments, dt=datetime))
+        self.edit_wiki_page("user/" + awardee, new_content, "Updated awards.")
+
+    def find_top_n(self, leaderboard, n):
+        """ Picks the n awardees with the most awards from a monthly
+        leaderboard, breaking ties in count by first award that month """
+        tops = heapq.nlargest(n, leaderboard, key=itemgetter('num_awards'))
         return sorted(tops, key=lambda x: (x['num_awards'], -x['earliest_award_time']))
 
-    def clear_leader_flair_css(self):
-        top_csses = [value for key, value in self.config.flair.items()
-            if key.startswith('top')]
-        current_flairs = self.subreddit.get_flair_list()
-        for flair in current_flairs:
-            for css in top_csses:
-                flair_class = flair['flair_css_class']
-                if css in flair_class:
-                    new_flair_class = re.sub(r'\s?' + css + r'\s?', ' ', 
-                        flair_class).strip()
+    def update_awardee(self, awardee):
+        user_awards = self.get_user_awards(awardee)
+        with self.metrics.phase('flair'):
+            self.adjust_point_flair(awardee, user_awards.num_awards)
+        with self.metrics.phase('wiki'):
+            self.update_wiki_tracker(awardee, user_awards)
+
+    def update_scoreboard(self, year, month):
+        with self.metrics.phase('wiki'):
+            self.update_monthly_scoreboard(year, month,
+                self.db.fetch_monthly_leaderboard(year, month))
+
+    def update_leaders(self):
+        now = datetime.utcnow()
+        top10 = self.find_top_n(self.db.fetch_monthly_leaderboard(now.year, now.month), 10)
+        with self.metrics.phase('flair'):
+            self.update_top_css([top['awardee'] for top in top10])
+        with self.metrics.phase('sidebar'):
+            self.update_sidebar_scoreboard(top10, now.strftime('%b'))
+
+    def run_due_jobs(self):
+        """ Runs the pending update jobs that have come due. A job that fails
+        is retried after the debounce window, doubled with every failure, and
+        dropped after update_job_max_attempts failures in a row. Returns when
+        the next pending job is due, None if there are none. """
+        jobs = self.db.fetch_due_jobs(time.time())
+        if jobs:
+            self.flair_mirror.reconcile_if_due()
+        handlers = {
+            'awardee': self.update_awardee,
+            'scoreboard': self.update_scoreboard,
+            'leaders': self.update_leaders,
+            'first_award_message': self.send_first_time_message,
+        }
+        for job in jobs:
+            try:
+                handlers[job['kind']](**json.loads(job['args']))
+            except Exception:
+                logging.error("Update of %s failed:\n%s" % (job['target'],
+                    traceback.format_exc()))
+                attempts = job['attempts'] + 1
+                if attempts >= (self.config.update_job_max_attempts or 6):
+                    logging.error("Giving up on %s after %d failed attempts"
+                        % (job['target'], attempts))
+                    # kept only if its target changed while it was running
+                    self.db.complete_job(job, time.time() + self.update_debounce_window)
                 else:
-                    new_flair_class = ''
-            self.subreddit.set_flair(flair['user'], 
-                flair_text=flair['flair_text'], flair_css_class=new_flair_class)
+                    delay = self.update_debounce_window * 2 ** (attempts - 1)
+                    self.db.reschedule_job(job, time.time() + delay)
+            else:
+                self.db.complete_job(job, time.time() + self.update_debounce_window)
+        return self.db.fetch_next_job_time()
+
+    def report_metrics(self, **fields):
+        """ Logs one line of JSON summing up the iteration that just ended,
+        and writes the totals to metrics_file if it is set """
+        summary = self.metrics.end_iteration(scheduler=self.scheduler.stats(),
+            polling=self.poll_interval.stats(), **fields)
+        logging.info("Iteration metrics: %s" % json.dumps(summary, sort_keys=True))
+        if self.config.metrics_file:
+            path = self.config.metrics_file
+            if self.shard:
+                path += '.%d' % self.shard[0]
+            self.metrics.write(path)
+        return summary
 
     def go(self):
         """ Start DeltaBot. """
         self.running = True
-        reset_counter = 0
-        while self.running:
-            old_comment_id = self.scanned_comments[-1] if self.scanned_comments else None
-            logging.info("Starting iteration at %s" % old_comment_id or "None")
-
-            self.scan_inbox()
-            self.scan_mod_mail()
-            self.scan_comments()
-
-            if reset_counter == 0:
-                self.rescan_comments()
-                
-            awardees = set([comment.author.name for comment 
-                in self.awarded_comments])
-            while awardees:
-                awardee = awardees.pop()
-                awards = self.db.fetch_awards_by_awardee(awardee)
-
-                num = len(awards)
-                current_awards = [comment for comment in self.awarded_comments 
-                    if comment.author.name == awardee]
-                if num == len(current_awards):
-                    self.send_first_time_message(awardee)
-                self.adjust_point_flair(awardee, num)
-                self.update_wiki_tracker(awardee, awards)
-
-                if len(awardees) == 0:
-                    now = datetime.utcnow()
-                    monthly_awards = self.db.fetch_awards_by_month(now.year, now.month)
-                    self.update_monthly_scoreboard(now.year, now.month, monthly_awards)
-                    top10 = self.find_top_n(monthly_awards, 10)
-                    self.update_top_css([top['awardee'] for top in top10])
-                    self.update_sidebar_scoreboard(top10, now.strftime('%b'))
-
-            self.awarded_comments.clear()
-
-            if self.scanned_comments and (old_comment_id is not self.scanned_comments[-1]):
-                write_saved_id(self.config.last_comment_filename,
-                               self.scanned_comments[-1])
-
-            logging.info("Iteration complete at %s" % (self.scanned_comments[-1] if
-                                                       self.scanned_comments else "None"))
-            reset_counter += 1
-            print("Reset Counter at %s." % reset_counter)
-            print("When this reaches 10, the script will clear its history.")
-            if reset_counter == 10:
-                self.scanned_comments.clear()
-                reset_counter = 0
-            logging.info("Sleeping for %s seconds" % self.config.sleep_time)
-            time.sleep(self.config.sleep_time)
+        while self.running and not (self.stop is not None and self.stop.is_set()):
+            if not self.is_primary():
+                self.follow_checkpoint_reset()
+            logging.info("Starting iteration at %s" % self.checkpoint.high_water_mark)
+
+            if self.is_primary():
+                with self.metrics.phase('inbox'):
+                    self.scan_inbox()
+                    self.scan_mod_mail()
+            with self.metrics.phase('scan'):
+                new_comments = self.scan_comments()
+            interval = self.poll_interval.observe(new_comments)
+
+            if self.is_primary():
+                with self.metrics.phase('rescan'):
+                    self.rescan_comments()
+                self.run_due_jobs()
+                self.backfill_award_roots()
+
+            logging.debug("Ancestor cache: %s" % self.ancestors.stats())
+            self.report_metrics(new_comments=new_comments,
+                high_water_mark=self.checkpoint.high_water_mark)
+            logging.info("Sleeping for %.1f seconds" % interval)
+            if self.stop is not None:
+                self.stop.wait(interval)
+            else:
+                time.sleep(interval)
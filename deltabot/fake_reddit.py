@@ -0,0 +1,447 @@
+"""
+A local stand-in for the parts of reddit's API that DeltaBot uses, for end
+to end load tests with the real PRAW client making real HTTP requests.
+Start it from the repository root, e.g.:
+
+    python deltabot/fake_reddit.py --port 8080 --comment-rate 5 --latency 0.3
+
+and point the bot at it by adding "reddit_url": "http://127.0.0.1:8080" to
+config.json. The server keeps one subreddit in memory, with the comments,
+flair, wiki pages, sidebar, inbox and moderators the bot reads and writes,
+and can be made slow or unreliable:
+
+    latency, jitter        seconds every response is held back
+    error_rate             share of requests failing with error_status
+    throttle_rate          share of requests refused with 429
+    requests_per_window    reddit's rate limit, with the X-Ratelimit headers;
+                           once a window's budget is spent, every request is
+                           refused with 429 until the window resets
+"""
+import re
+import csv
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import benchmarks
+
+
+def listing(children, after=None):
+    return {'kind': 'Listing', 'data': {'children': children, 'after': after,
+                                        'before': None, 'modhash': ''}}
+
+
+def api_response(errors=(), **data):
+    """ The {"json": ...} envelope reddit wraps the results of actions in """
+    return {'json': {'errors': list(errors), 'data': data}}
+
+
+class FakeReddit(object):
+    """ The server's state: one subreddit and everything in it. Things are
+    kept as the json dicts reddit would send, by fullname. Safe to share
+    between the server's threads. """
+
+    def __init__(self, subreddit='subreddit', moderators=('username',)):
+        self.subreddit = subreddit
+        self.lock = threading.RLock()
+        self.ids = iter(range(36 ** 6, 36 ** 7))
+        self.things = {}
+        self.comments = []  # fullnames, oldest first
+        self.flair = {}
+        self.wiki = {}
+        self.settings = {'title': subreddit, 'description': 'Rules\n\n_____\n\nScoreboard',
+                         'public_description': '', 'language': 'en',
+                         'subreddit_id': 't5_' + benchmarks.base36(1),
+                         'subreddit_type': 'public'}
+        self.moderators = list(moderators)
+        self.inbox = []
+        self.unread = set()
+        self.sent_messages = []
+        self.requests = 0
+
+    def new_name(self, kind):
+        return kind + '_' + benchmarks.base36(next(self.ids))
+
+    def add_submission(self, author, title='', selftext=''):
+        with self.lock:
+            name = self.new_name('t3')
+            self.things[name] = {'id': name[3:], 'name': name, 'author': author,
+                'title': title, 'selftext': selftext, 'subreddit': self.subreddit,
+                'subreddit_id': self.settings['subreddit_id'], 'created_utc': time.time(),
+                'permalink': '/r/%s/comments/%s/_/' % (self.subreddit, name[3:]),
+                'num_comments': 0, 'score': 1, 'distinguished': None, 'edited': False}
+            return self.things[name]
+
+    def add_comment(self, parent_id, author, body):
+        with self.lock:
+            parent = self.things[parent_id]
+            link_id = parent.get('link_id', parent_id)
+            name = self.new_name('t1')
+            self.things[name] = {'id': name[3:], 'name': name, 'author': author,
+                'body': body, 'parent_id': parent_id, 'link_id': link_id,
+                'link_title': self.things[link_id]['title'], 'subreddit': self.subreddit,
+                'subreddit_id': self.settings['subreddit_id'], 'created_utc': time.time(),
+                'permalink': self.things[link_id]['permalink'] + name[3:],
+                'replies': '', 'score': 1, 'distinguished': None, 'edited': False}
+            self.comments.append(name)
+            return self.things[name]
+
+    def add_message(self, author, subject, body):
+        """ Delivers a private message to the bot's inbox """
+        with self.lock:
+            name = self.new_name('t4')
+            self.things[name] = {'id': name[3:], 'name': name, 'author': author,
+                'dest': self.moderators[0] if self.moderators else '',
+                'subject': subject, 'body': body, 'was_comment': False,
+                'created_utc': time.time(), 'new': True, 'replies': '',
+                'parent_id': None, 'first_message_name': None, 'context': ''}
+            self.inbox.append(name)
+            self.unread.add(name)
+            return self.things[name]
+
+    def thing(self, name):
+        return {'kind': name[:2], 'data': self.things[name]}
+
+    def subreddit_thing(self):
+        return {'kind': 't5', 'data': {'id': self.settings['subreddit_id'][3:],
+            'name': self.settings['subreddit_id'], 'display_name': self.subreddit,
+            'title': self.settings['title'], 'url': '/r/%s/' % self.subreddit}}
+
+    # GET endpoints, which are given the query parameters and the groups of
+    # the route's pattern
+
+    def comments_listing(self, params):
+        """ /r/{subreddit}/comments, newest first """
+        limit = min(int(params.get('limit', 25)), 100)
+        # like reddit, the listing only reaches back 1000 comments
+        newest = self.comments[:-1001:-1]
+        start = newest.index(params['after']) + 1 if params.get('after') in newest else 0
+        page = newest[start:start + limit]
+        after = page[-1] if start + len(page) < len(newest) else None
+        return listing([self.thing(name) for name in page], after)
+
+    def info(self, params):
+        names = [name for name in params.get('id', '').split(',') if name in self.things]
+        return listing([self.thing(name) for name in names[:100]])
+
+    def submission_page(self, params, link_id, comment_id=None):
+        """ /comments/{link_id}/_/{comment_id}, a submission and a comment """
+        link_name = 't3_' + link_id
+        if link_name not in self.things:
+            return 404, {'error': 404}
+        comments = ['t1_' + comment_id] if comment_id else []
+        return [listing([self.thing(link_name)]),
+                listing([self.thing(name) for name in comments if name in self.things])]
+
+    def about(self, params, subreddit):
+        return self.subreddit_thing()
+
+    def about_edit(self, params, subreddit):
+        return {'kind': 'subreddit_settings', 'data': dict(self.settings)}
+
+    def moderators_list(self, params, subreddit):
+        return {'kind': 'UserList', 'data': {'children': [
+            {'name': name, 'id': 't2_' + name, 'mod_permissions': ['all'],
+             'date': 0} for name in self.moderators]}}
+
+    def my_moderation(self, params):
+        return listing([self.subreddit_thing()])
+
+    def flair_list(self, params, subreddit):
+        users = sorted(self.flair)
+        start = users.index(params['after']) + 1 if params.get('after') in self.flair else 0
+        page = users[start:start + min(int(params.get('limit', 1000)), 1000)]
+        return {'users': [{'user': user, 'flair_text': self.flair[user][0],
+                           'flair_css_class': self.flair[user][1]} for user in page],
+                'next': page[-1] if start + len(page) < len(users) else None}
+
+    def wiki_page(self, params, subreddit, page):
+        if page not in self.wiki:
+            return 404, {'error': 404, 'reason': 'PAGE_NOT_CREATED'}
+        return {'kind': 'wikipage', 'data': {'content_md': self.wiki[page],
+                                             'may_revise': True, 'revision_by': None}}
+
+    def user_about(self, params, user):
+        return {'kind': 't2', 'data': {'name': user, 'id': benchmarks.base36(len(user)),
+                                       'has_mail': bool(self.unread)}}
+
+    def unread_messages(self, params):
+        names = [name for name in self.inbox if name in self.unread]
+        if params.get('mark') == 'true':
+            self.unread.difference_update(names)
+        return listing([self.thing(name) for name in reversed(names)])
+
+    def inbox_messages(self, params):
+        return listing([self.thing(name) for name in reversed(self.inbox)])
+
+    # POST endpoints, which are given the form data and the route's groups
+
+    def login(self, form, user=None):
+        return api_response(modhash='modhash', cookie='cookie')
+
+    def comment(self, form):
+        parent_id = form['thing_id']
+        if parent_id not in self.things:
+            return api_response([['NO_THING_ID', "that comment doesn't exist", 'thing_id']])
+        author = self.moderators[0] if self.moderators else ''
+        reply = self.add_comment(parent_id, author, form['text'])
+        return api_response(things=[self.thing(reply['name'])])
+
+    def distinguish(self, form, how=None):
+        if form['id'] in self.things:
+            self.things[form['id']]['distinguished'] = 'moderator'
+        return api_response(things=[self.thing(form['id'])] if form['id'] in self.things else [])
+
+    def edit(self, form):
+        thing = self.things.get(form['thing_id'])
+        if thing is None:
+            return api_response([['NO_THING_ID', "that comment doesn't exist", 'thing_id']])
+        thing['body'] = form['text']
+        thing['edited'] = time.time()
+        return api_response(things=[self.thing(form['thing_id'])])
+
+    def delete(self, form):
+        thing = self.things.get(form['id'])
+        if thing is not None:
+            thing['author'] = '[deleted]'
+            thing['body'] = '[deleted]'
+        return {}
+
+    def set_flair(self, form):
+        self.flair[form['name']] = (form.get('text', ''), form.get('css_class', ''))
+        return api_response()
+
+    def set_flair_csv(self, form):
+        results = []
+        # reddit reads the rows as CSV, so fields PRAW sends unquoted shift
+        for row in csv.reader(form.get('flair_csv', '').splitlines()):
+            user, text, css_class = (row + ['', ''])[:3]
+            self.flair[user] = (text, css_class)
+            results.append({'ok': True, 'status': 'added flair for user %s' % user,
+                            'warnings': {}, 'errors': {}})
+        return results
+
+    def wiki_edit(self, form, subreddit=None):
+        self.wiki[form['page']] = form['content']
+        return {}
+
+    def site_admin(self, form):
+        self.settings['description'] = form.get('description', self.settings['description'])
+        self.settings['title'] = form.get('title', self.settings['title'])
+        return api_response()
+
+    def compose(self, form):
+        self.sent_messages.append((form.get('to', ''), form.get('subject', ''),
+                                   form.get('text', '')))
+        return api_response()
+
+    def read_message(self, form):
+        for name in form.get('id', '').split(','):
+            self.unread.discard(name)
+        return {}
+
+
+ROUTES = [
+    ('GET', r'r/[^/]+/comments', 'comments_listing'),
+    ('GET', r'api/info', 'info'),
+    ('GET', r'comments/(\w+)(?:/[^/]*/(\w+))?', 'submission_page'),
+    ('GET', r'r/([^/]+)/about', 'about'),
+    ('GET', r'r/([^/]+)/about/edit', 'about_edit'),
+    ('GET', r'r/([^/]+)/about/moderators', 'moderators_list'),
+    ('GET', r'subreddits/mine/moderator', 'my_moderation'),
+    ('GET', r'r/([^/]+)/api/flairlist', 'flair_list'),
+    ('GET', r'r/([^/]+)/wiki/(.+)', 'wiki_page'),
+    ('GET', r'user/([^/]+)/about', 'user_about'),
+    ('GET', r'message/unread', 'unread_messages'),
+    ('GET', r'message/inbox', 'inbox_messages'),
+    ('POST', r'api/login(?:/([^/]+))?', 'login'),
+    ('POST', r'api/comment', 'comment'),
+    ('POST', r'api/distinguish(?:/(\w+))?', 'distinguish'),
+    ('POST', r'api/editusertext', 'edit'),
+    ('POST', r'api/del', 'delete'),
+    ('POST', r'api/flair', 'set_flair'),
+    ('POST', r'api/flaircsv', 'set_flair_csv'),
+    ('POST', r'(?:r/([^/]+)/)?api/wiki/edit', 'wiki_edit'),
+    ('POST', r'api/site_admin', 'site_admin'),
+    ('POST', r'api/compose', 'compose'),
+    ('POST', r'api/read_message', 'read_message'),
+]
+ROUTES = [(method, re.compile('/?' + pattern + r'/?(?:\.json)?$'), name)
+          for method, pattern, name in ROUTES]
+
+
+class Faults(object):
+    """ Decides which requests are delayed or refused, and tracks the rate
+    limit window behind the X-Ratelimit headers """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, error_status=500,
+                 throttle_rate=0, requests_per_window=None, window=600,
+                 rng=None, clock=time.time):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.requests_per_window = requests_per_window
+        self.window = window
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.window_start = clock()
+        self.used = 0
+        self.injected = {}
+
+    def delay(self):
+        return max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def check(self):
+        """ Returns the status to fail the request with, None to serve it,
+        and the rate limit headers to send either way """
+        with self.lock:
+            now = self.clock()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.used = 0
+            self.used += 1
+            headers = {}
+            status = None
+            if self.requests_per_window is not None:
+                remaining = self.requests_per_window - self.used
+                reset = self.window - (now - self.window_start)
+                headers = {'X-Ratelimit-Used': str(self.used),
+                           'X-Ratelimit-Remaining': str(max(0, remaining)),
+                           'X-Ratelimit-Reset': str(int(reset))}
+                if remaining < 0:
+                    status = 429
+                    headers['Retry-After'] = str(int(reset) + 1)
+            if status is None and self.rng.random() < self.throttle_rate:
+                status = 429
+            elif status is None and self.rng.random() < self.error_rate:
+                status = self.error_status
+            if status is not None:
+                self.injected[status] = self.injected.get(status, 0) + 1
+            return status, headers
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug("fake_reddit: " + format % args)
+
+    def do_GET(self):
+        self.handle_api('GET', parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        self.handle_api('POST', parse_qs(body, keep_blank_values=True))
+
+    def handle_api(self, method, query):
+        fake, faults = self.server.fake, self.server.faults
+        time.sleep(faults.delay())
+        status, headers = faults.check()
+        if status is not None:
+            return self.respond(status, {'error': status}, headers)
+        path = urlsplit(self.path).path
+        args = {key: values[-1] for key, values in query.items()}
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                try:
+                    with fake.lock:
+                        fake.requests += 1
+                        result = getattr(fake, name)(args, *match.groups())
+                except Exception:
+                    logging.exception("fake_reddit: %s %s failed" % (method, path))
+                    return self.respond(500, {'error': 500}, headers)
+                if isinstance(result, tuple):
+                    status, result = result
+                return self.respond(status or 200, result, headers)
+        self.respond(404, {'error': 404}, headers)
+
+    def respond(self, status, result, headers):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(fake, faults, host='127.0.0.1', port=0):
+    """ Starts the server in a daemon thread and returns it. Its url is
+    'http://%s:%d' % server.server_address. """
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    server.faults = faults
+    thread = threading.Thread(target=server.serve_forever, name='fake-reddit',
+        daemon=True)
+    thread.start()
+    return server
+
+
+def post_comments(fake, rng, rate, **kwargs):
+    """ Adds rate comments a second to fake, forever, from
+    benchmarks.comment_stream, which takes the other arguments """
+    def add_comment(parent, author, body):
+        return fake.add_comment(parent['name'], author, body)
+
+    def edit(comment, body):
+        with fake.lock:
+            comment.update(body=body, edited=time.time())
+
+    for _ in benchmarks.comment_stream(rng, fake.add_submission, add_comment, edit,
+                                       **kwargs):
+        time.sleep(rng.expovariate(rate))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--subreddit', default='subreddit')
+    parser.add_argument('--moderator', action='append', default=None,
+        help="the bot's account, which replies are posted as")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--requests-per-window', type=int, default=None)
+    parser.add_argument('--window', type=float, default=600)
+    parser.add_argument('--comment-rate', type=float, default=0,
+        help="synthetic comments posted per second")
+    parser.add_argument('--token-rate', type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    fake = FakeReddit(args.subreddit, args.moderator or ['username'])
+    faults = Faults(args.latency, args.jitter, args.error_rate, args.error_status,
+        args.throttle_rate, args.requests_per_window, args.window, random.Random(args.seed))
+    server = serve(fake, faults, args.host, args.port)
+    print("Serving /r/%s on http://%s:%d" % ((args.subreddit,) + server.server_address))
+    try:
+        if args.comment_rate:
+            post_comments(fake, rng, args.comment_rate, token_rate=args.token_rate)
+        else:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    print("%d requests served, injected failures: %s" % (fake.requests, faults.injected))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Keeps a local mirror of user flair and computes flair changes so that they
+can be pushed to reddit in bulk through the flair CSV endpoint, which takes
+up to 100 users per request.
+"""
+import time
+import logging
+
+from scheduler import FLAIR
+
+# PRAW joins a CSV row's fields with commas and no quoting, so reddit would
+# split a field holding any of these
+CSV_UNSAFE = (',', '"', '\n', '\r')
+
+
+def css_classes(css):
+    """ Splits a flair css class string into its classes """
+    return (css or '').split()
+
+
+def top_classes(flair_config):
+    """ The css classes that mark the monthly leaders """
+    return set(value for key, value in flair_config.items() if key.startswith('top'))
+
+
+def leader_css(css, rank, flair_config):
+    """ The css class string a user should have given their rank among the
+    leaders, None if they aren't a leader """
+    leader_classes = top_classes(flair_config)
+    classes = [c for c in css_classes(css) if c not in leader_classes]
+    if rank is not None:
+        classes.append(flair_config['top1'] if rank == 0 else flair_config['top10'])
+    return ' '.join(classes)
+
+
+def flair_row(user, flair_text, flair_css_class):
+    return {'user': user, 'flair_text': flair_text or '',
+            'flair_css_class': flair_css_class or ''}
+
+
+def csv_safe(flair):
+    """ Whether the row can go through set_flair_csv as it is """
+    return not any(char in (flair[field] or '') for char in CSV_UNSAFE
+                   for field in ('user', 'flair_text', 'flair_css_class'))
+
+
+def leader_flair_changes(current_flairs, leaders, flair_config):
+    """
+    Diffs the current flair of every user against the flair they should have
+    with the given leaders, in order, holding the leader classes. Returns the
+    rows for set_flair_csv of the users whose flair has to change.
+    """
+    ranks = {leader: rank for rank, leader in enumerate(leaders)}
+    changes = []
+    seen = set()
+    for flair in current_flairs:
+        user = flair['user']
+        seen.add(user)
+        desired = leader_css(flair['flair_css_class'], ranks.get(user), flair_config)
+        if css_classes(desired) != css_classes(flair['flair_css_class']):
+            changes.append(flair_row(user, flair['flair_text'], desired))
+    for leader in leaders:
+        if leader not in seen:
+            changes.append(flair_row(leader, None,
+                leader_css(None, ranks[leader], flair_config)))
+    return changes
+
+
+class FlairMirror(object):
+    """
+    A copy of the subreddit's user flair kept in the database, so reading a
+    user's flair costs no API call. It is seeded from the flair list, updated
+    on every write the bot makes and reconciled with the flair list every
+    reconcile_interval seconds to pick up edits made by moderators.
+    """
+
+    def __init__(self, db, subreddit, reconcile_interval, request=None):
+        self.db = db
+        self.subreddit = subreddit
+        self.reconcile_interval = reconcile_interval
+        # request(priority, fn, *args) makes an API call, see DeltaBot.request
+        self.request = request or (lambda priority, fn, *args, endpoint=None: fn(*args))
+
+    def reconcile(self):
+        logging.info("Reconciling the flair mirror with the flair list")
+        flair_list = self.request(FLAIR, list, self.subreddit.get_flair_list(limit=None),
+            endpoint='get_flair_list')
+        flairs = [flair_row(flair['user'], flair['flair_text'], flair['flair_css_class'])
+                  for flair in flair_list]
+        self.db.replace_flair(flairs)
+        self.db.set_state('flair_reconciled_at', time.time())
+
+    def reconcile_if_due(self):
+        last_reconciled = self.db.fetch_state('flair_reconciled_at')
+        if last_reconciled is None or \
+                time.time() - last_reconciled >= self.reconcile_interval:
+            self.reconcile()
+
+    def get(self, user):
+        return self.db.fetch_flair(user) or flair_row(user, None, None)
+
+    def all(self):
+        return self.db.fetch_all_flair()
+
+    def set(self, flairs):
+        """ Pushes the given flair rows to reddit and records them. Rows
+        set_flair_csv would garble, and lone rows, are set one at a time. """
+        in_bulk = [flair for flair in flairs if csv_safe(flair)]
+        one_at_a_time = [flair for flair in flairs if not csv_safe(flair)]
+        if len(in_bulk) < 2:
+            in_bulk, one_at_a_time = [], flairs
+        for flair in one_at_a_time:
+            self.request(FLAIR, self.subreddit.set_flair, flair['user'],
+                flair['flair_text'], flair['flair_css_class'])
+        if in_bulk:
+            self.request(FLAIR, self.subreddit.set_flair_csv, in_bulk)
+        self.db.update_flair(flairs)
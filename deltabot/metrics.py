@@ -0,0 +1,134 @@
+"""
+Instrumentation for DeltaBot's main loop. Metrics keeps the wall time spent
+in each phase and the number of comments given each dispo, alongside the
+counters other components keep for themselves (API calls by endpoint in the
+request scheduler, calls by method in the DatabaseManager), and reports them
+two ways:
+
+    end_iteration()  a summary of what changed since the last iteration,
+                     which DeltaBot logs as one line of JSON
+    render()         all the totals in Prometheus' text format, which
+                     DeltaBot writes to metrics_file and serves on
+                     metrics_port at /metrics
+
+The phases of the main loop are inbox, scan and rescan, then flair, wiki,
+sidebar and messages for the update jobs. The async engine's stages run at
+the same time, so it times fetch, evaluate and reply instead of scan.
+"""
+import os
+import time
+import logging
+import threading
+import contextlib
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics(object):
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.phase_seconds = collections.Counter()
+        self.dispos = collections.Counter()
+        self.iterations = 0
+        self.iteration_started = clock()
+        self.last_iteration_seconds = 0
+        # (metric name, summary key, help, label, counter)
+        self.counters = []
+        self.previous = {}
+        self.add_counter('deltabot_phase_seconds_total', 'phases',
+            "Wall time spent in each phase of the main loop.", 'phase',
+            self.phase_seconds)
+        self.add_counter('deltabot_comments_total', 'dispos',
+            "Comments evaluated, by dispo.", 'dispo', self.dispos)
+
+    def add_counter(self, name, key, help, label, counter):
+        """ Reports a dict of running totals, such as a Counter another
+        component keeps up to date, as the metric name """
+        self.counters.append((name, key, help, label, counter))
+        self.previous[key] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Adds the wall time the block takes to the phase's total """
+        started = self.clock()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phase_seconds[name] += self.clock() - started
+
+    def count_dispo(self, dispo):
+        with self.lock:
+            self.dispos[dispo] += 1
+
+    def end_iteration(self, **fields):
+        """ Returns how much each counter has grown since the last
+        iteration, along with the given fields """
+        with self.lock:
+            now = self.clock()
+            self.last_iteration_seconds = now - self.iteration_started
+            self.iteration_started = now
+            self.iterations += 1
+            summary = {'iteration': self.iterations,
+                       'seconds': round(self.last_iteration_seconds, 3)}
+            for _, key, _, _, counter in self.counters:
+                totals = dict(counter)
+                previous = self.previous[key]
+                summary[key] = {name: round(total - previous.get(name, 0), 3)
+                                for name, total in totals.items()
+                                if total != previous.get(name, 0)}
+                self.previous[key] = totals
+        summary.update(fields)
+        return summary
+
+    def render(self):
+        """ The totals in Prometheus' text exposition format """
+        lines = ['# HELP deltabot_iterations_total Iterations of the main loop.',
+                 '# TYPE deltabot_iterations_total counter',
+                 'deltabot_iterations_total %d' % self.iterations,
+                 '# HELP deltabot_last_iteration_seconds Wall time of the last iteration.',
+                 '# TYPE deltabot_last_iteration_seconds gauge',
+                 'deltabot_last_iteration_seconds %s' % self.last_iteration_seconds]
+        for name, _, help, label, counter in self.counters:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for value, total in sorted(dict(counter).items()):
+                escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('%s{%s="%s"} %s' % (name, label, escaped, total))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Writes render() to path, replacing it in one step so a scraper
+        never reads half a file """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format % args)
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    """ Serves metrics at /metrics from a daemon thread and returns the
+    server """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name='deltabot-metrics',
+        daemon=True).start()
+    return server
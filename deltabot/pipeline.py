@@ -0,0 +1,156 @@
+"""
+An asyncio engine for DeltaBot, selected with "engine": "async" in the
+config, that runs the main loop as a pipeline instead of one phase after
+another:
+
+    fetch -> evaluate -> reply
+
+Each stage is a coroutine that hands its blocking PRAW work to a worker
+thread of its own, and the stages are connected by bounded queues, so the
+replies to one page of comments are posted while the next page is being
+evaluated. Every stage has a single consumer reading a FIFO queue, so each
+comment passes through the stages in order and comments are handled in the
+order they were fetched. A fourth stage runs the bot's update jobs as they
+come due. The API calls made by every stage go through the
+bot's request scheduler, so all stages share one rate limit and replies are
+not held up behind wiki and flair updates.
+"""
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import deltabot
+
+
+class AsyncEngine(object):
+    def __init__(self, bot):
+        self.bot = bot
+        self.queue_size = bot.config.pipeline_queue_size or 4
+        self.executors = {}
+        # the fetch stage's own checkpoint, which runs ahead of bot.checkpoint
+        self.fetched = bot.checkpoint.copy()
+        self.checkpoint_resets = bot.checkpoint_resets
+
+    async def run_blocking(self, stage, fn, *args):
+        """ Runs fn in the stage's worker thread """
+        executor = self.executors.get(stage)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix='deltabot-' + stage)
+            self.executors[stage] = executor
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    async def fetch(self):
+        while self.bot.running:
+            logging.info("Starting iteration at %s" % self.fetched.high_water_mark)
+            await self.replies.put(('inbox', None))
+            if self.checkpoint_resets != self.bot.checkpoint_resets:
+                # a reset command has cleared the bot's checkpoint
+                self.checkpoint_resets = self.bot.checkpoint_resets
+                self.fetched = self.bot.checkpoint.copy()
+            with self.bot.metrics.phase('fetch'):
+                comments = await self.run_blocking('fetch', self.bot.fresh_comments,
+                    self.fetched)
+            self.fetched.advance(comment.name for comment in comments)
+            for page in deltabot.chunks(comments, 100):
+                await self.pages.put(page)
+            interval = self.bot.poll_interval.observe(len(comments))
+            await self.replies.put(('rescan', None))
+            # the other stages are still working through this iteration, so
+            # the summary covers whatever they finished since the last one
+            self.bot.report_metrics(new_comments=len(comments),
+                high_water_mark=self.fetched.high_water_mark)
+            logging.info("Sleeping for %.1f seconds" % interval)
+            await asyncio.sleep(interval)
+        # let the other stages drain before the engine stops
+        for queue in (self.pages, self.replies):
+            await queue.join()
+
+    def evaluate_page(self, page):
+        with self.bot.metrics.phase('evaluate'):
+            self.bot.parents.clear()
+            self.bot.prefetch_parents(page)
+            results = []
+            for comment in page:
+                logging.info("Processing comment {} by {}".format(
+                    comment.permalink, comment.author.name))
+                dispo, parent = self.bot.dispo_comment(comment)
+                results.append((comment, dispo, parent))
+            return results
+
+    async def evaluate(self):
+        while True:
+            page = await self.pages.get()
+            results = await self.run_blocking('evaluate', self.evaluate_page, page)
+            await self.replies.put(('page', results))
+            self.pages.task_done()
+
+    def revalidate(self, comment, dispo, parent):
+        """ A page is evaluated before the replies to the page ahead of it
+        are applied, so an award confirmed then may since have been made
+        redundant. already_awarded_by_bot only reads the database, but the
+        tree check finds the root of the parent's tree, which calls get_info
+        for any ancestors the ancestor cache has lost since evaluation. """
+        if dispo == deltabot.dispos['confirmed']:
+            if self.bot.already_awarded_by_bot(comment):
+                return deltabot.dispos['already_awarded_by_bot']
+            if self.bot.already_awarded_in_this_tree(comment, parent):
+                return deltabot.dispos['already_awarded_in_this_tree']
+        return dispo
+
+    def apply(self, kind, payload):
+        with self.bot.metrics.phase('reply' if kind == 'page' else kind):
+            if kind == 'inbox':
+                self.bot.scan_inbox()
+                self.bot.scan_mod_mail()
+            elif kind == 'rescan':
+                self.bot.rescan_comments()
+            elif kind == 'page':
+                with self.bot.db.unit_of_work():
+                    for comment, dispo, parent in payload:
+                        self.bot.apply_dispo(comment,
+                            self.revalidate(comment, dispo, parent), parent)
+                    self.bot.checkpoint.advance(comment.name for comment, _, _ in payload)
+                    self.bot.save_checkpoint()
+
+    async def reply(self):
+        while True:
+            kind, payload = await self.replies.get()
+            await self.run_blocking('reply', self.apply, kind, payload)
+            self.replies.task_done()
+
+    async def update(self):
+        while True:
+            next_due_time = await self.run_blocking('update', self.bot.run_due_jobs)
+            await self.run_blocking('update', self.bot.backfill_award_roots)
+            delay = self.bot.config.sleep_time
+            if delay is None:
+                delay = 60
+            if next_due_time is not None:
+                delay = min(delay, max(0, next_due_time - time.time()))
+            await asyncio.sleep(delay)
+
+    async def main(self):
+        self.pages = asyncio.Queue(self.queue_size)
+        self.replies = asyncio.Queue(self.queue_size)
+        tasks = [asyncio.ensure_future(stage()) for stage in
+                 (self.fetch, self.evaluate, self.reply, self.update)]
+        # only fetch returns normally, the other stages run until cancelled
+        try:
+            done, pending = await asyncio.wait(tasks,
+                return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            task.result()
+
+    def run(self):
+        """ Start DeltaBot on the async engine. """
+        self.bot.running = True
+        try:
+            asyncio.run(self.main())
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=False)
@@ -1,6 +1,7 @@
-
+import time
 import random
 import string
+import itertools
 
 
 def reddit_id(length=6):
@@ -11,7 +12,8 @@ def reddit_id(length=6):
 # The following classes are meant to emulate various PRAW objects
 # They do not contain all of the same attributes if the original
 # PRAW class, but only the necessary ones needed for testing the
-# process_unread function.
+# process_unread function, and for driving a whole DeltaBot in the
+# load benchmark.
 
 class Reddit(object):
     def __init__(self):
@@ -23,24 +25,47 @@ class Reddit(object):
         # verify if get_submission is working correctly.
         self._get_sub_comment = None
         self.info = dict()
+        self.user = None
+        self.subreddit = Subreddit(self)
+        self.sent_messages = []
+        self.wiki = dict()
+        self.moderators = []
+        self.unread = []
 
     def set_info(self, thing_id, value):
         self.info[thing_id] = value
 
+    def add(self, thing):
+        """ Makes a comment or submission visible to get_info """
+        self.info[thing.name] = thing
+
     def get_info(self, thing_id):
-        return self.info[thing_id]
+        if isinstance(thing_id, (list, tuple)):
+            return [self.info[name] for name in thing_id if name in self.info]
+        return self.info.get(thing_id)
 
-    def login(*args, **kwargs):
-        pass
+    def login(self, username=None, *args, **kwargs):
+        self.user = Author(username or '')
 
-    def get_subreddit(*args, **kwargs):
-        return Subreddit()
+    def get_subreddit(self, *args, **kwargs):
+        return self.subreddit
 
     def send_message(self, recipient, subject, text, **kwargs):
         self._sent_message = True
         self._message_recipient = recipient
         self._message_subject = subject
         self._message_text = text
+        self.sent_messages.append((recipient, subject, text))
+
+    def edit_wiki_page(self, subreddit, page, content, reason=''):
+        self.wiki[page] = content
+
+    def get_moderators(self, subreddit):
+        return self.moderators
+
+    def get_unread(self, *args, **kwargs):
+        unread, self.unread = self.unread, []
+        return iter(unread)
 
     def get_submission(self, *args, **kwargs):
         s = Submission()
@@ -50,16 +75,42 @@ class Reddit(object):
 
 
 class Subreddit(object):
-    def __init__(self):
-        pass
+    def __init__(self, reddit_session=None):
+        self.reddit_session = reddit_session
+        self.comments = []  # oldest first
+        self.flair = dict()
+        self.settings = {'description': 'Rules\n\n_____\n\nScoreboard'}
+
+    def get_comments(self, limit=None, **kwargs):
+        # like reddit, the listing is newest first and ends after 1000 items
+        return itertools.islice(reversed(self.comments), limit or 1000)
+
+    def get_flair_list(self, *args, **kwargs):
+        return iter([{'user': user, 'flair_text': text, 'flair_css_class': css}
+                     for user, (text, css) in self.flair.items()])
+
+    def set_flair(self, user, flair_text='', flair_css_class=''):
+        self.flair[user] = (flair_text, flair_css_class)
+
+    def set_flair_csv(self, flair_mapping):
+        for flair in flair_mapping:
+            self.set_flair(flair['user'], flair['flair_text'], flair['flair_css_class'])
+
+    def get_settings(self):
+        return dict(self.settings)
+
+    def update_settings(self, **kwargs):
+        self.settings.update(kwargs)
 
 
 class Repliable(object):
-    def __init__(self, author=None, body='', reddit_session=None, replies=[]):
+    def __init__(self, author=None, body='', reddit_session=None, replies=[],
+                 id=None, created_utc=None):
         self.author = author or Author()
         self.body = body
         self.replies = replies
-        self.id = reddit_id()
+        self.id = id or reddit_id()
+        self.created_utc = created_utc if created_utc is not None else time.time()
         self.reddit_session = reddit_session
         self._replied_to = False
         self._reply_text = ''
@@ -67,6 +118,11 @@ class Repliable(object):
     def reply(self, text):
         self._replied_to = True
         self._reply_text = text
+        if self.reddit_session is not None:
+            reply = Comment(author=self.reddit_session.user, body=text,
+                reddit_session=self.reddit_session, parent=self)
+            self.reddit_session.add(reply)
+            return reply
 
 
 class Author(object):
@@ -90,19 +146,42 @@ class Message(Repliable):
 
 
 class Submission(Repliable):
-    def __init__(self, *args,  **kwargs):
+    def __init__(self, *args, **kwargs):
+        self.title = kwargs.pop('title', '')
+        self.selftext = kwargs.pop('selftext', '')
         Repliable.__init__(self, *args, **kwargs)
+        self.name = 't3_' + self.id
+        self.permalink = '/comments/' + self.id
+        self.comments = []
 
 
 class Comment(Repliable):
     def __init__(self, *args, **kwargs):
+        parent = kwargs.pop('parent', None)
         Repliable.__init__(self, *args, **kwargs)
+        self.name = 't1_' + self.id
         self.was_comment = True
         self.permalink = reddit_id() + '/test/' + self.id
         self._edited = False
         self._edit_text = ''
-        self.submission = Submission()
+        self._distinguished = False
+        self._deleted = False
+        if parent is None:
+            self.submission = Submission()
+        elif isinstance(parent, Submission):
+            self.submission = parent
+        else:
+            self.submission = parent.submission
+        self.parent_id = parent.name if parent is not None else self.submission.name
+        self.link_id = self.submission.name
 
     def edit(self, text):
         self._edited = True
-        self._edit_text = text
\ No newline at end of file
+        self._edit_text = text
+        self.body = text
+
+    def distinguish(self):
+        self._distinguished = True
+
+    def delete(self):
+        self._deleted = True
@@ -0,0 +1,33 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket refilled at rate tokens per second, holding at
+    most capacity tokens. It never blocks: try_acquire() says how long to
+    wait instead, so RequestScheduler can wait on its own condition.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """ Takes the tokens if they are available and returns 0, otherwise
+        takes nothing and returns how long until they will be """
+        with self.lock:
+            self.refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
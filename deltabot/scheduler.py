@@ -0,0 +1,146 @@
+"""
+Every Reddit API call DeltaBot makes goes through a RequestScheduler, which
+paces them with a token bucket and, when several threads are waiting for a
+token, lets the highest priority request go first.
+
+Priorities only reorder requests that are waiting at the same time, so they
+take effect in the async engine, whose stages make their calls from separate
+threads. The default engine, like each sharded worker, makes one call at a
+time from a single thread, and there they only label the requests in
+stats(); the order of its main loop, replies before update jobs, is what
+puts replies first.
+"""
+import time
+import heapq
+import itertools
+import threading
+import collections
+
+import ratelimit
+
+# Priority classes, most urgent first. REPLY covers everything on the path
+# from a new comment to the bot's reply to it.
+REPLY = 0
+INBOX = 1
+FLAIR = 2
+WIKI = 3
+
+PRIORITY_NAMES = {REPLY: 'reply', INBOX: 'inbox', FLAIR: 'flair', WIKI: 'wiki'}
+
+
+class RequestScheduler(object):
+    def __init__(self, bucket, clock=time.monotonic):
+        self.bucket = bucket
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+        self.queue_depth = collections.Counter()
+        self.requests = collections.Counter()
+        self.wait_time = collections.Counter()
+        self.max_wait_time = collections.Counter()
+        self.endpoint_calls = collections.Counter()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Reddit allows 30 requests a minute to clients logged in with a
+        password, 60 to OAuth clients """
+        return cls(ratelimit.TokenBucket(
+            (config.api_requests_per_minute or 30) / 60.0, config.api_burst or 5))
+
+    def wait_for_turn(self, priority):
+        entry = (priority, next(self.counter))
+        started = self.clock()
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            self.queue_depth[priority] += 1
+            while True:
+                delay = None
+                if self.waiting[0] == entry:
+                    delay = self.bucket.try_acquire()
+                    if not delay:
+                        heapq.heappop(self.waiting)
+                        break
+                self.condition.wait(delay)
+            self.queue_depth[priority] -= 1
+            self.condition.notify_all()
+        waited = self.clock() - started
+        self.requests[priority] += 1
+        self.wait_time[priority] += waited
+        self.max_wait_time[priority] = max(self.max_wait_time[priority], waited)
+
+    def call(self, priority, fn, *args, endpoint=None, **kwargs):
+        """ Calls fn once the request is at the front of the queue and the
+        rate limit allows it. The call is counted under endpoint, which
+        defaults to fn's name. """
+        self.wait_for_turn(priority)
+        self.endpoint_calls[endpoint or getattr(fn, '__name__', repr(fn))] += 1
+        return fn(*args, **kwargs)
+
+    def iterate(self, priority, iterable, endpoint=None):
+        """ Yields from iterable, scheduling each step as a request. Meant
+        for iterating pages of a listing, where each step is one request. """
+        iterator = iter(iterable)
+        done = object()
+        while True:
+            item = self.call(priority, next, iterator, done, endpoint=endpoint)
+            if item is done:
+                return
+            yield item
+
+    def stats(self):
+        """ Queue depth, requests and wait times for each priority class """
+        return {name: {'queue_depth': self.queue_depth[priority],
+                       'requests': self.requests[priority],
+                       'total_wait': round(self.wait_time[priority], 3),
+                       'max_wait': round(self.max_wait_time[priority], 3)}
+                for priority, name in PRIORITY_NAMES.items()}
+
+
+class AdaptivePollInterval(object):
+    """
+    Picks how long to wait before polling for new comments again from the
+    rate they have been arriving at, smoothed with an exponentially weighted
+    moving average. The interval aims for about target_comments new comments
+    per poll, so the bot polls often in a surge and rarely in a lull.
+    """
+
+    def __init__(self, initial_interval, min_interval, max_interval,
+                 target_comments=25, smoothing=0.3, clock=time.monotonic):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_comments = target_comments
+        self.smoothing = smoothing
+        self.clock = clock
+        self.rate = None
+        self.last_poll = None
+        self.interval = self.clamp(initial_interval)
+
+    @classmethod
+    def from_config(cls, config):
+        initial = config.sleep_time if config.sleep_time is not None else 60
+        return cls(initial, config.poll_interval_min or 10,
+            config.poll_interval_max or 300, config.poll_target_comments or 25,
+            config.poll_smoothing or 0.3)
+
+    def clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def observe(self, new_comments):
+        """ Records how many new comments a poll found and returns the delay
+        before the next one """
+        now = self.clock()
+        if self.last_poll is not None and now > self.last_poll:
+            sample = new_comments / (now - self.last_poll)
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate = self.smoothing * sample + (1 - self.smoothing) * self.rate
+            self.interval = self.clamp(self.target_comments / self.rate
+                if self.rate else self.max_interval)
+        self.last_poll = now
+        return self.interval
+
+    def stats(self):
+        return {'comments_per_second': round(self.rate or 0, 3),
+                'interval': round(self.interval, 1)}
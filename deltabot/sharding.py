@@ -0,0 +1,181 @@
+"""
+Sharded mode, selected with "engine": "sharded" in the config. Several
+worker processes scan the subreddit side by side, each logged in with its
+own account and handling only the submissions that hash to its shard:
+
+    shard 0 uses "account", shard n uses shard_accounts[n - 1]
+
+Every worker runs the ordinary DeltaBot loop, but its DatabaseManager is a
+RemoteDatabase that forwards each call to one writer process holding the
+only SQLite connection. Because every lookup goes to that one database,
+checks such as already_awarded_by_bot hold across shards. Shard 0 also
+handles the inbox, rescans and the update jobs; the other shards only scan.
+When any worker exits, as shard 0 does for the stop command, the others are
+stopped after their current iteration and the writer after them.
+"""
+import pickle
+import logging
+import traceback
+import contextlib
+import collections
+import multiprocessing
+import multiprocessing.connection
+from types import SimpleNamespace
+
+import config
+import db
+import deltabot
+
+# DatabaseManager methods with no result, which a worker can hold back and
+# send in the same message as its next call that needs an answer
+BUFFERED_METHODS = frozenset(['log_dispo', 'delete_dispo_log', 'postpone_rescan',
+    'save_checkpoint', 'set_award_root', 'enqueue_jobs', 'set_state'])
+
+# methods that read the submission of the comments they are given
+SUBMISSION_METHODS = frozenset(['award_point', 'previous_awards_in_submission'])
+
+COMMENT_FIELDS = ('id', 'name', 'body', 'permalink', 'created_utc')
+SUBMISSION_FIELDS = COMMENT_FIELDS + ('title', 'selftext')
+
+
+def snapshot(value, with_submission=False, fields=COMMENT_FIELDS):
+    """ Copies the attributes the database reads from a praw object into
+    something that can be pickled and sent to the writer """
+    if value is None or isinstance(value, (str, int, float, list, dict, tuple)):
+        return value
+    if isinstance(value, collections.deque):  # a checkpoint's recent comments
+        return list(value)
+    copy = SimpleNamespace(**{field: getattr(value, field, None) for field in fields})
+    author = getattr(value, 'author', None)
+    copy.author = SimpleNamespace(name=author.name if author else None)
+    if with_submission:
+        copy.submission = snapshot(value.submission, fields=SUBMISSION_FIELDS)
+    return copy
+
+
+class RemoteDatabase(object):
+    """
+    Stands in for a DatabaseManager in a worker process. Calls are sent to
+    the writer process as batches; the writer runs a batch in one unit of
+    work and acknowledges it with the result of its last call. Inside a
+    unit_of_work block, calls to BUFFERED_METHODS are held back until a call
+    that needs an answer, a flush or the end of the block.
+    """
+
+    def __init__(self, requests, responses, worker):
+        self.requests = requests
+        self.responses = responses
+        self.worker = worker
+        self.depth = 0
+        self.pending = []
+        self.method_calls = collections.Counter()
+
+    def send(self, batch):
+        # pickled here so an error is raised in the caller, see serve_database
+        self.requests.put(pickle.dumps((self.worker, batch)))
+        ok, result = pickle.loads(self.responses.get())
+        if not ok:
+            raise RuntimeError("Database writer failed:\n" + result)
+        return result
+
+    def call(self, name, *args, **kwargs):
+        self.method_calls[name] += 1
+        with_submission = name in SUBMISSION_METHODS
+        args = tuple(snapshot(arg, with_submission) for arg in args)
+        self.pending.append((name, args, kwargs))
+        if self.depth and name in BUFFERED_METHODS:
+            return None
+        batch, self.pending = self.pending, []
+        return self.send(batch)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        self.depth += 1
+        # if the block raises, the calls it held back are dropped; any held
+        # back now belong to an enclosing block, unless they have been sent
+        pending, held = self.pending, len(self.pending)
+        try:
+            yield
+        except BaseException:
+            if self.pending is pending:
+                del pending[held:]
+            else:
+                self.pending = []
+            raise
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            batch, self.pending = self.pending, []
+            self.send(batch)
+
+
+def serve_database(manager, requests, responses):
+    """ Runs batches of calls from the workers against manager until it
+    receives None. Responses are pickled here rather than by the queue,
+    whose feeder thread would drop one it can't pickle and leave the worker
+    waiting forever. """
+    while True:
+        message = requests.get()
+        if message is None:
+            return
+        worker, batch = pickle.loads(message)
+        try:
+            with manager.unit_of_work():
+                for name, args, kwargs in batch:
+                    result = getattr(manager, name)(*args, **kwargs)
+            response = pickle.dumps((True, result))
+        except Exception:
+            response = pickle.dumps((False, traceback.format_exc()))
+        responses[worker].put(response)
+
+
+def run_writer(attrs, requests, responses):
+    serve_database(db.DatabaseManager(config.Config(attrs).database), requests, responses)
+
+
+def run_worker(attrs, shard, requests, responses, stop):
+    conf = config.Config(attrs)
+    num_shards = 1 + len(conf.shard_accounts or [])
+    if shard > 0:
+        conf = config.Config(dict(attrs, account=conf.shard_accounts[shard - 1]))
+    logging.info("Starting shard %d of %d" % (shard, num_shards))
+    reddit_client = deltabot.reddit_client(conf)
+    bot = deltabot.DeltaBot(conf, reddit_client,
+        database=RemoteDatabase(requests, responses, shard),
+        shard=(shard, num_shards), stop=stop)
+    bot.go()
+
+
+def run(conf):
+    """ Start DeltaBot in sharded mode and wait for the workers to exit. """
+    num_shards = 1 + len(conf.shard_accounts or [])
+    requests = multiprocessing.Queue()
+    responses = [multiprocessing.Queue() for _ in range(num_shards)]
+    stop = multiprocessing.Event()
+    writer = multiprocessing.Process(target=run_writer, name='deltabot-writer',
+        args=(conf.attrs, requests, responses))
+    writer.start()
+    workers = [multiprocessing.Process(target=run_worker, name='deltabot-shard-%d' % shard,
+                   args=(conf.attrs, shard, requests, responses[shard], stop))
+               for shard in range(num_shards)]
+    for worker in workers:
+        worker.start()
+    multiprocessing.connection.wait([worker.sentinel for worker in workers])
+    for shard, worker in enumerate(workers):
+        if worker.exitcode is not None:
+            logging.warning("Shard %d exited with code %s, stopping the other shards"
+                % (shard, worker.exitcode))
+    stop.set()
+    for worker in workers:
+        worker.join()
+    requests.put(None)
+    writer.join()
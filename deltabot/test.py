@@ -31,11 +31,38 @@ if sys.version_info > (3, 3):
     from unittest import mock
 else:
     import mock
+import asyncio
+import collections
+import contextlib
+import io
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import warnings
+from datetime import datetime
+from types import SimpleNamespace
 
+import benchmarks
+import cache
+import checkpoint
 import config
+import db
 import deltabot
+import fake_reddit
+import metrics
+import pipeline
+import praw_mocks
+import sharding
+import scheduler
 import praw
 
 test_config = config.Config(os.getcwd() + '/config/config.json')
@@ -50,7 +77,9 @@ def test_suite():
 class DeltaBotTestCase(unittest.TestCase):
     def setUp(self):
         MockReddit = mock.create_autospec(praw.Reddit)
-        self.bot = deltabot.DeltaBot(config=test_config, reddit=MockReddit())
+        bot_config = config.Config(dict(test_config.attrs, database=':memory:',
+            api_requests_per_minute=60000, api_burst=1000))
+        self.bot = deltabot.DeltaBot(config=bot_config, reddit=MockReddit())
 
 class TestScanComment(DeltaBotTestCase):
 
@@ -282,6 +311,45 @@ class TestAncestorPoints(DeltaBotTestCase):
     def test_with_root_comment(self):
         pass
 
+class TestAncestorCache(unittest.TestCase):
+    def setUp(self):
+        # t1_c is a reply to t1_b, which is a reply to the root comment t1_a
+        self.tree = {'t1_a': 't3_sub', 't1_b': 't1_a', 't1_c': 't1_b', 't1_d': 't1_b'}
+        self.fetch = mock.Mock(side_effect=lambda name: self.tree[name])
+        self.cache = cache.AncestorCache(self.fetch, maxsize=100)
+
+    def test_root_comment_is_its_own_root(self):
+        self.assertEqual(self.cache.root_of('t1_a', 't3_sub'), 't1_a')
+        self.assertFalse(self.fetch.called)
+
+    def test_walk_fills_cache(self):
+        self.assertEqual(self.cache.root_of('t1_c'), 't1_a')
+        self.assertEqual(self.fetch.call_count, 3)
+        self.assertEqual(self.cache.misses, 3)
+
+        self.assertEqual(self.cache.root_of('t1_c'), 't1_a')
+        self.assertEqual(self.fetch.call_count, 3)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_walk_stops_at_known_ancestor(self):
+        self.cache.root_of('t1_c')
+        self.fetch.reset_mock()
+
+        self.assertEqual(self.cache.root_of('t1_d', 't1_b'), 't1_a')
+        self.assertFalse(self.fetch.called)
+
+    def test_deep_thread_does_not_recurse(self):
+        self.tree = {'t1_0': 't3_sub'}
+        self.tree.update({'t1_%d' % n: 't1_%d' % (n - 1) for n in range(1, 5000)})
+        self.cache = cache.AncestorCache(self.fetch, maxsize=10000)
+        self.assertEqual(self.cache.root_of('t1_4999'), 't1_0')
+
+    def test_eviction(self):
+        self.cache = cache.AncestorCache(self.fetch, maxsize=2)
+        self.cache.root_of('t1_c')
+        self.assertEqual(len(self.cache.parents), 2)
+        self.assertEqual(len(self.cache.roots), 2)
+
 class TestIsCommentTooShort(DeltaBotTestCase):
     def test_no_comment(self):
         no_comment = mock.Mock(spec=praw.objects.Comment, body="")
@@ -304,64 +372,1231 @@ class TestIsCommentTooShort(DeltaBotTestCase):
         self.assertFalse(result, "is_comment_too_short() returns True with long comment")
 
 class TestUpdateTopCSS(DeltaBotTestCase):
-    def setUp(self):
-        super().setUp()
-        self.bot.clear_leader_flair_css = mock.create_autospec(self.bot.clear_leader_flair_css)
-
     def test_no_leaders(self):
         leaders = []
         
         self.bot.update_top_css(leaders)
         
         self.assertFalse(self.bot.subreddit.set_flair.called, "attempted to set flair even though leaders list was empty")
+        self.assertFalse(self.bot.subreddit.set_flair_csv.called, "attempted to set flair even though leaders list was empty")
 
     def test_list_of_already_flaired_leaders(self):
         leaders = ['amy', 'bob', 'carl', 'dina']
-        self.bot.subreddit.get_flair.return_value = {
-            'flair_text': 'some flair text', 
-            'flair_css_class': 'flairclass', 
-            'user': 'someone' }
+        self.bot.subreddit.get_flair_list.return_value = [
+            {'user': leader, 'flair_text': 'some flair text', 'flair_css_class': 'flairclass'}
+            for leader in leaders]
+        self.bot.flair_mirror.reconcile()
 
         self.bot.update_top_css(leaders)
 
-        self.assertEqual(self.bot.subreddit.set_flair.call_count, len(leaders), 'css not updated for all leaders in list')
-        for i, call_args in enumerate(self.bot.subreddit.set_flair.call_args_list):
-            self.assertEqual(call_args[0][0], leaders[i])
+        self.assertFalse(self.bot.subreddit.set_flair.called)
+        rows = self.bot.subreddit.set_flair_csv.call_args[0][0]
+        self.assertEqual(len(rows), len(leaders), 'css not updated for all leaders in list')
+        for i, row in enumerate(rows):
+            self.assertEqual(row['user'], leaders[i])
             if i == 0:
-                self.assertEqual(call_args[1], {'flair_text': 'some flair text', 'flair_css_class': 'flairclass ' + self.bot.config.flair['top1']})
+                self.assertEqual(row, {'user': leaders[i], 'flair_text': 'some flair text', 'flair_css_class': 'flairclass ' + self.bot.config.flair['top1']})
             else:
-                self.assertEqual(call_args[1], {'flair_text': 'some flair text', 'flair_css_class': 'flairclass ' + self.bot.config.flair['top10']})
+                self.assertEqual(row, {'user': leaders[i], 'flair_text': 'some flair text', 'flair_css_class': 'flairclass ' + self.bot.config.flair['top10']})
 
     def test_list_of_unflaired_leaders(self):
         leaders = ['amy', 'bob', 'carl', 'dina']
-        self.bot.subreddit.get_flair.return_value = {
-            'flair_text': None, 
-            'flair_css_class': None, 
-            'user': 'someone' }
 
         self.bot.update_top_css(leaders)
 
-        self.assertEqual(self.bot.subreddit.set_flair.call_count, len(leaders), 'css not updated for all leaders in list')
-        for i, call_args in enumerate(self.bot.subreddit.set_flair.call_args_list):
-            self.assertEqual(call_args[0][0], leaders[i])
+        rows = self.bot.subreddit.set_flair_csv.call_args[0][0]
+        self.assertEqual(len(rows), len(leaders), 'css not updated for all leaders in list')
+        for i, row in enumerate(rows):
+            self.assertEqual(row['user'], leaders[i])
             if i == 0:
-                self.assertEqual(call_args[1], {'flair_text': None, 'flair_css_class': self.bot.config.flair['top1']})
+                self.assertEqual(row, {'user': leaders[i], 'flair_text': '', 'flair_css_class': self.bot.config.flair['top1']})
             else:
-                self.assertEqual(call_args[1], {'flair_text': None, 'flair_css_class': self.bot.config.flair['top10']})
+                self.assertEqual(row, {'user': leaders[i], 'flair_text': '', 'flair_css_class': self.bot.config.flair['top10']})
+
+    def test_only_changed_flair_is_pushed(self):
+        leaders = ['amy', 'bob']
+        top10 = self.bot.config.flair['top10']
+        self.bot.subreddit.get_flair_list.return_value = [
+            {'user': 'amy', 'flair_text': '1', 'flair_css_class': 'points'},
+            {'user': 'bob', 'flair_text': '2', 'flair_css_class': 'points ' + top10},
+            {'user': 'carl', 'flair_text': '3', 'flair_css_class': 'points ' + top10},
+            {'user': 'dina', 'flair_text': '4', 'flair_css_class': 'points'}]
+        self.bot.flair_mirror.reconcile()
+
+        self.bot.update_top_css(leaders)
+
+        rows = self.bot.subreddit.set_flair_csv.call_args[0][0]
+        self.assertEqual(rows, [
+            {'user': 'amy', 'flair_text': '1', 'flair_css_class': 'points ' + self.bot.config.flair['top1']},
+            {'user': 'carl', 'flair_text': '3', 'flair_css_class': 'points'}])
+
+    def test_flair_with_commas_set_one_at_a_time(self):
+        leaders = ['amy', 'bob', 'carl']
+        top10 = self.bot.config.flair['top10']
+        self.bot.subreddit.get_flair_list.return_value = [
+            {'user': 'amy', 'flair_text': 'Mod, 12∆', 'flair_css_class': 'points'},
+            {'user': 'bob', 'flair_text': '2∆', 'flair_css_class': 'points'},
+            {'user': 'carl', 'flair_text': '"3∆"', 'flair_css_class': 'points'},
+            {'user': 'dina', 'flair_text': '4∆', 'flair_css_class': 'points ' + top10}]
+        self.bot.flair_mirror.reconcile()
+
+        self.bot.update_top_css(leaders)
+
+        self.assertEqual([row['user'] for row in
+            self.bot.subreddit.set_flair_csv.call_args[0][0]], ['bob', 'dina'])
+        self.assertEqual([call[0][:2] for call in self.bot.subreddit.set_flair.call_args_list],
+            [('amy', 'Mod, 12∆'), ('carl', '"3∆"')])
+        self.assertEqual(self.bot.flair_mirror.get('amy')['flair_css_class'],
+            'points ' + self.bot.config.flair['top1'])
 
 class TestAdjustPointFlair(DeltaBotTestCase):
     def setUp(self):
         super().setUp()
-        self.bot.subreddit.get_flair.return_value = {
+        self.bot.db.update_flair([{
             'flair_text': 'some flair text', 
             'flair_css_class': 'flairclass', 
-            'user': 'someone' }
+            'user': 'someone' }])
 
     def test_adding_points(self):
         self.bot.adjust_point_flair('someone', 5)
 
         self.assertEqual(self.bot.subreddit.set_flair.call_args[0][:2], ('someone', self.bot.config.flair['point_text'] % 5))
         self.assertIn(self.bot.config.flair['css_class'], self.bot.subreddit.set_flair.call_args[0][2])
+        self.assertFalse(self.bot.subreddit.get_flair.called)
+
+    def test_mirror_updated_on_write(self):
+        self.bot.adjust_point_flair('someone', 5)
+
+        self.assertEqual(self.bot.flair_mirror.get('someone'), {
+            'user': 'someone', 'flair_text': self.bot.config.flair['point_text'] % 5,
+            'flair_css_class': 'flairclass ' + self.bot.config.flair['css_class']})
+
+class TestFlairMirror(DeltaBotTestCase):
+    def test_seeded_once(self):
+        self.assertEqual(self.bot.subreddit.get_flair_list.call_count, 1)
+        self.bot.flair_mirror.reconcile_if_due()
+        self.assertEqual(self.bot.subreddit.get_flair_list.call_count, 1)
+
+    def test_reconcile_when_due(self):
+        self.bot.db.set_state('flair_reconciled_at',
+            time.time() - self.bot.flair_mirror.reconcile_interval)
+        self.bot.subreddit.get_flair_list.return_value = [
+            {'user': 'amy', 'flair_text': None, 'flair_css_class': 'modset'}]
+
+        self.bot.flair_mirror.reconcile_if_due()
+
+        self.assertEqual(self.bot.flair_mirror.all(), [
+            {'user': 'amy', 'flair_text': '', 'flair_css_class': 'modset'}])
+
+class TestPrefetchParents(DeltaBotTestCase):
+    def make_comment(self, n, body):
+        comment = mock.Mock(body=body, parent_id='t1_parent%d' % n)
+        parent = mock.Mock()
+        parent.name = comment.parent_id
+        return comment, parent
+
+    def test_only_token_bearing_parents_fetched_in_one_call(self):
+        pairs = [self.make_comment(n, test_config.tokens[0] if n % 2 else "no token")
+            for n in range(10)]
+        self.bot.reddit.get_info.return_value = [parent for n, (comment, parent)
+            in enumerate(pairs) if n % 2]
+
+        self.bot.prefetch_parents([comment for comment, parent in pairs])
+
+        self.assertEqual(self.bot.reddit.get_info.call_count, 1)
+        self.assertEqual(sorted(self.bot.reddit.get_info.call_args[1]['thing_id']),
+            sorted(parent.name for n, (comment, parent) in enumerate(pairs) if n % 2))
+        comment, parent = pairs[1]
+        self.assertIs(self.bot.get_parent(comment), parent)
+        self.assertEqual(self.bot.reddit.get_info.call_count, 1)
+
+    def test_requests_are_chunked_by_100(self):
+        comments = [self.make_comment(n, test_config.tokens[0])[0] for n in range(250)]
+        self.bot.reddit.get_info.return_value = []
+
+        self.bot.prefetch_parents(comments)
+
+        self.assertEqual([len(call[1]['thing_id']) for call in
+            self.bot.reddit.get_info.call_args_list], [100, 100, 50])
+
+def mock_award(submission_id='sub', awarded_id='awarded', awarded_author='amy',
+        awarding_id='awarding', awarding_author='bob', awarding_time=0):
+    """ Builds a pair of mock comments suitable for DatabaseManager.award_point """
+    submission = mock.Mock(id=submission_id, title='title', selftext='text',
+        body='', permalink='/sub', created_utc=0)
+    submission.name = 't3_' + submission_id
+    submission.author.name = 'op'
+    awarded = mock.Mock(id=awarded_id, body='awarded', permalink='/awarded',
+        created_utc=awarding_time, submission=submission)
+    awarded.name = 't1_' + awarded_id
+    awarded.author.name = awarded_author
+    awarding = mock.Mock(id=awarding_id, body='awarding', permalink='/awarding',
+        created_utc=awarding_time, submission=submission)
+    awarding.name = 't1_' + awarding_id
+    awarding.author.name = awarding_author
+    return awarded, awarding
+
+class TestAwardRoots(unittest.TestCase):
+    def test_previous_awards_match_on_root(self):
+        manager = db.DatabaseManager(':memory:')
+        awarded, awarding = mock_award()
+        manager.award_point(awarded, awarding, 'root1')
+
+        self.assertTrue(manager.previous_awards_in_submission(awarded, awarding, 'root1'))
+        self.assertFalse(manager.previous_awards_in_submission(awarded, awarding, 'root2'))
+
+    def test_old_awards_table_gains_root_column(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'awards.db')
+            conn = sqlite3.connect(path)
+            conn.row_factory = sqlite3.Row
+            db.create_tables(conn)
+            conn.execute('''INSERT INTO awards (submission_id, awarded_comment_id,
+                awarding_comment_id) VALUES ('sub', 'awarded', 'awarding')''')
+            conn.commit()
+            conn.close()
+
+            manager = db.DatabaseManager(path)
+            self.assertEqual(manager.schema_version(), db.SCHEMA_VERSION)
+            self.assertEqual(manager.fetch_awarded_comments_missing_root(), ['awarded'])
+            manager.set_award_root('awarded', 'root1')
+            self.assertEqual(manager.fetch_awarded_comments_missing_root(), [])
+            manager.db.close()
+
+    def test_backfill_query_uses_partial_index(self):
+        manager = db.DatabaseManager(':memory:')
+        plan = ' '.join(row['detail'] for row in manager.db.execute('''EXPLAIN QUERY PLAN
+            SELECT awarded_comment_id FROM awards WHERE root_comment_id IS NULL
+            GROUP BY awarded_comment_id ORDER BY MAX(awarding_comment_time) DESC'''))
+        self.assertIn('awards_missing_root', plan)
+
+class TestBackfillAwardRoots(DeltaBotTestCase):
+    def test_trees_walked_in_bulk(self):
+        parents = {'t1_a1': 't1_c1', 't1_c1': 't3_sub', 't1_a2': 't3_sub',
+                   't1_a3': 't1_gone'}
+        def get_info(thing_id):
+            things = []
+            for name in thing_id:
+                if name in parents:
+                    things.append(mock.Mock(parent_id=parents[name]))
+                    things[-1].name = name
+            return things
+        self.bot.reddit.get_info.side_effect = get_info
+        for n in range(1, 4):
+            awarded, awarding = mock_award(awarded_id='a%d' % n, awarding_id='b%d' % n)
+            self.bot.db.award_point(awarded, awarding, None)
+
+        with self.assertLogs(level='WARNING'):
+            self.bot.backfill_award_roots()
+
+        self.assertEqual(self.bot.reddit.get_info.call_count, 2)
+        roots = self.bot.db.db.execute(
+            'SELECT awarded_comment_id, root_comment_id FROM awards ORDER BY 1')
+        self.assertEqual([tuple(row) for row in roots],
+            [('a1', 'c1'), ('a2', 'a2'), ('a3', '')])
+        self.assertEqual(self.bot.db.fetch_awarded_comments_missing_root(), [])
+
+    def test_one_batch_at_a_time_newest_first(self):
+        self.bot.config.root_backfill_batch_size = 2
+        self.bot.reddit.get_info.return_value = []
+        for n in (1, 0, 2):
+            awarded, awarding = mock_award(awarded_id='a%d' % n, awarding_id='b%d' % n,
+                awarding_time=n)
+            self.bot.db.award_point(awarded, awarding, None)
+
+        with self.assertLogs(level='WARNING'):
+            self.bot.backfill_award_roots()
+
+        self.assertEqual(self.bot.db.fetch_awarded_comments_missing_root(), ['a0'])
+
+class TestCommentIdSets(unittest.TestCase):
+    def setUp(self):
+        self.manager = db.DatabaseManager(':memory:')
+        self.comment = mock.Mock(id='c1', created_utc=0)
+
+    def test_unknown_comments_skip_the_database(self):
+        self.manager.db = mock.Mock(wraps=self.manager.db)
+        self.assertIsNone(self.manager.fetch_dispo_log_by_comment(self.comment))
+        self.assertFalse(self.manager.already_awarded_by_bot(self.comment))
+        self.assertFalse(self.manager.db.cursor.called)
+
+    def test_sets_follow_writes(self):
+        self.manager.log_dispo(self.comment, 6, mock.Mock(id='r1'))
+        self.assertEqual(self.manager.fetch_dispo_log_by_comment(self.comment)['reply_id'], 'r1')
+        self.manager.delete_dispo_log(self.comment)
+        self.assertIsNone(self.manager.fetch_dispo_log_by_comment(self.comment))
+
+        awarded, awarding = mock_award()
+        self.manager.award_point(awarded, awarding, 'root')
+        self.assertTrue(self.manager.already_awarded_by_bot(awarding))
+
+    def test_sets_are_loaded_at_startup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'awards.db')
+            manager = db.DatabaseManager(path)
+            awarded, awarding = mock_award()
+            manager.award_point(awarded, awarding, 'root')
+            manager.log_dispo(self.comment, 6, mock.Mock(id='r1'))
+            manager.db.close()
+
+            manager = db.DatabaseManager(path)
+            self.assertTrue(manager.already_awarded_by_bot(awarding))
+            self.assertIsNotNone(manager.fetch_dispo_log_by_comment(self.comment))
+            manager.db.close()
+
+class TestUnitOfWork(DeltaBotTestCase):
+    def count(self, table):
+        return self.bot.db.db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def test_writes_wait_for_the_outermost_block(self):
+        comment = mock.Mock(id='c1', created_utc=0)
+        with self.bot.db.unit_of_work():
+            self.bot.db.log_dispo(comment, 6, mock.Mock(id='r1'))
+            with self.bot.db.unit_of_work():
+                self.bot.db.postpone_rescan('c1', 100)
+            self.assertEqual(self.count('dispo_log'), 0)
+        row = self.bot.db.db.execute(
+            'SELECT next_rescan_time, rescan_attempts FROM dispo_log').fetchone()
+        self.assertEqual(tuple(row), (100, 1))
+
+    def test_writes_dropped_if_block_raises(self):
+        comment = mock.Mock(id='c1', created_utc=0)
+        awarded, awarding = mock_award()
+        with self.bot.db.unit_of_work():
+            self.bot.db.log_dispo(comment, 6, mock.Mock(id='r1'))
+            with self.assertRaises(ValueError):
+                with self.bot.db.unit_of_work():
+                    self.bot.db.postpone_rescan('c1', 100)
+                    self.bot.db.award_point(awarded, awarding, 'root')
+                    raise ValueError('boom')
+        self.assertEqual(self.count('awards'), 0)
+        self.assertFalse(self.bot.db.already_awarded_by_bot(awarding))
+        row = self.bot.db.db.execute(
+            'SELECT next_rescan_time, rescan_attempts FROM dispo_log').fetchone()
+        self.assertEqual(tuple(row), (None, 0))
+
+    def test_runs_of_a_statement_are_batched(self):
+        with self.bot.db.unit_of_work():
+            for n in range(3):
+                self.bot.db.postpone_rescan('c%d' % n, 100)
+            self.bot.db.set_award_root('c0', 'root')
+            self.assertEqual([len(rows) for sql, rows in self.bot.db.local.pending], [3, 1])
+
+    def test_reply_writes_are_committed_with_the_reply(self):
+        awarded, awarding = mock_award(awarding_time=time.time())
+        awarded.name, awarded.parent_id = 't1_awarded', 't3_sub'
+        awarding.reply.return_value = mock.Mock(id='r1')
+        self.bot.get_reply_text = mock.Mock(return_value='reply')
+
+        with self.bot.db.unit_of_work():
+            self.bot.save_checkpoint()
+            self.bot.apply_dispo(awarding, deltabot.dispos['confirmed'], awarded)
+            self.assertEqual(self.count('dispo_log'), 1)
+            self.assertEqual(self.count('awards'), 1)
+            self.assertEqual(self.count('update_jobs'), 4)
+            self.assertEqual(self.count('scan_checkpoints'), 1)
+
+    def test_reply_logged_before_it_is_distinguished(self):
+        awarded, awarding = mock_award(awarding_time=time.time())
+        awarded.name, awarded.parent_id = 't1_awarded', 't3_sub'
+        awarding.reply.return_value = mock.Mock(id='r1')
+        awarding.reply.return_value.distinguish.side_effect = Exception('timeout')
+        self.bot.get_reply_text = mock.Mock(return_value='reply')
+
+        with self.assertRaises(Exception):
+            with self.bot.db.unit_of_work():
+                self.bot.apply_dispo(awarding, deltabot.dispos['confirmed'], awarded)
+        self.assertEqual(self.count('dispo_log'), 1)
+        self.assertEqual(self.count('awards'), 1)
+
+    def test_no_reply_without_a_root(self):
+        awarded, awarding = mock_award(awarding_time=time.time())
+        awarded.name, awarded.parent_id = 't1_awarded', 't1_deleted'
+        self.bot.reddit.get_info.return_value = None
+
+        with self.assertRaises(AttributeError):
+            self.bot.apply_dispo(awarding, deltabot.dispos['confirmed'], awarded)
+        self.assertFalse(awarding.reply.called)
+        self.assertEqual(self.count('dispo_log'), 0)
+
+class TestMonthlyLeaderboard(unittest.TestCase):
+    def setUp(self):
+        self.db = db.DatabaseManager(':memory:')
+        self.june = datetime.timestamp(datetime(2015, 6, 10))
+        self.july = datetime.timestamp(datetime(2015, 7, 10))
+
+    def award(self, n, awardee, awarding_time):
+        awarded, awarding = mock_award(awarded_id='a%d' % n, awarding_id='b%d' % n,
+            awarded_author=awardee, awarding_time=awarding_time)
+        self.db.award_point(awarded, awarding, 'root')
+
+    def test_award_point_updates_rollup(self):
+        self.award(0, 'amy', self.june + 20)
+        self.award(1, 'bob', self.june)
+        self.award(2, 'amy', self.june + 10)
+        self.award(3, 'amy', self.july)
+
+        self.assertEqual(self.db.fetch_monthly_leaderboard(2015, 6), [
+            {'awardee': 'amy', 'num_awards': 2, 'earliest_award_time': self.june + 10},
+            {'awardee': 'bob', 'num_awards': 1, 'earliest_award_time': self.june}])
+        self.assertEqual(len(self.db.fetch_monthly_leaderboard(2015, 7)), 1)
+
+    def test_rollup_backfilled_from_existing_awards(self):
+        self.award(0, 'amy', self.june)
+        self.award(1, 'amy', self.june + 10)
+        self.db.db.execute('DROP TABLE monthly_leaderboard')
+        with self.db.db as conn:
+            db.add_monthly_leaderboard(conn)
+
+        self.assertEqual(self.db.fetch_monthly_leaderboard(2015, 6), [
+            {'awardee': 'amy', 'num_awards': 2, 'earliest_award_time': self.june}])
+
+class TestFindTopN(DeltaBotTestCase):
+    def test_ranking_and_tie_break(self):
+        leaderboard = [
+            {'awardee': 'amy', 'num_awards': 2, 'earliest_award_time': 30},
+            {'awardee': 'bob', 'num_awards': 3, 'earliest_award_time': 20},
+            {'awardee': 'cat', 'num_awards': 2, 'earliest_award_time': 10},
+            {'awardee': 'dan', 'num_awards': 1, 'earliest_award_time': 0}]
+
+        tops = self.bot.find_top_n(leaderboard, 3)
+
+        self.assertEqual([top['awardee'] for top in tops], ['amy', 'cat', 'bob'])
+
+class TestPublishIfChanged(DeltaBotTestCase):
+    def test_unchanged_wiki_page_not_edited(self):
+        self.bot.edit_wiki_page('user/amy', 'content', 'reason')
+        self.bot.edit_wiki_page('user/amy', 'content', 'reason')
+        self.assertEqual(self.bot.reddit.edit_wiki_page.call_count, 1)
+
+        self.bot.edit_wiki_page('user/amy', 'new content', 'reason')
+        self.bot.edit_wiki_page('user/bob', 'new content', 'reason')
+        self.assertEqual(self.bot.reddit.edit_wiki_page.call_count, 3)
+
+    def test_unchanged_sidebar_not_fetched(self):
+        self.bot.subreddit.get_settings.return_value = {'description': 'rules_____old'}
+        leaders = [{'awardee': 'amy', 'num_awards': 2, 'earliest_award_time': 0}]
+
+        self.bot.update_sidebar_scoreboard(leaders, 'Jun')
+        self.bot.update_sidebar_scoreboard(leaders, 'Jun')
+
+        self.assertEqual(self.bot.subreddit.get_settings.call_count, 1)
+        self.assertEqual(self.bot.subreddit.update_settings.call_count, 1)
+        self.assertTrue(self.bot.subreddit.update_settings.call_args[1]['description']
+            .startswith('rules_____'))
+
+    def test_failed_publish_is_retried(self):
+        self.bot.reddit.edit_wiki_page.side_effect = [Exception('timeout'), None]
+        with self.assertRaises(Exception):
+            self.bot.edit_wiki_page('user/amy', 'content', 'reason')
+        self.bot.edit_wiki_page('user/amy', 'content', 'reason')
+        self.assertEqual(self.bot.reddit.edit_wiki_page.call_count, 2)
+
+class TestUserAwards(DeltaBotTestCase):
+    def award(self, n, awarded_id, awarding_time):
+        awarded, awarding = mock_award(awarded_id=awarded_id, awarding_id='b%d' % n,
+            awarding_time=awarding_time)
+        awarded.name, awarded.parent_id = 't1_' + awarded_id, 't3_sub'
+        self.bot.award_point(awarded, awarding, awarded_id)
+
+    def test_incremental_matches_rebuild(self):
+        self.award(0, 'x', 30)
+        user_awards = self.bot.get_user_awards('amy')
+        self.award(1, 'y', 10)
+        self.award(2, 'x', 20)
+
+        self.assertIs(self.bot.get_user_awards('amy'), user_awards)
+        rebuilt = deltabot.UserAwards('amy', self.bot.db.fetch_awards_by_awardee('amy'))
+        self.assertEqual(user_awards.num_awards, 3)
+        self.assertEqual(list(user_awards.awarded_comments.items()),
+            list(rebuilt.awarded_comments.items()))
+        self.assertEqual([c['id'] for c in user_awards.awarded_comments['x']['awarding_comments']],
+            ['b2', 'b0'])
+
+    def test_snapshot_unaffected_by_later_awards(self):
+        self.award(0, 'x', 30)
+        num_awards, awarded_comments = self.bot.get_user_awards('amy').snapshot()
+        self.award(1, 'x', 10)
+        self.award(2, 'y', 20)
+
+        self.assertEqual(num_awards, 1)
+        self.assertEqual([[c['id'] for c in awarded_comment['awarding_comments']]
+            for awarded_comment in awarded_comments], [['b0']])
+
+    def test_wiki_page_lists_every_award(self):
+        self.award(0, 'x', 30)
+        self.award(1, 'y', 10)
+
+        self.bot.update_wiki_tracker('amy', self.bot.get_user_awards('amy'))
+
+        page, content = self.bot.reddit.edit_wiki_page.call_args[0][1:3]
+        self.assertEqual(page, 'user/amy')
+        self.assertIn('amy has received 2 deltas', content)
+        self.assertEqual(content.count('Awarded by /u/bob'), 2)
+
+class TestUpdateJobs(DeltaBotTestCase):
+    def award(self, n, awardee='amy'):
+        awarded, awarding = mock_award(awarded_id='a%d' % n, awarded_author=awardee,
+            awarding_id='b%d' % n, awarding_time=time.time())
+        awarded.name, awarded.parent_id = 't1_a%d' % n, 't3_sub'
+        self.bot.award_point(awarded, awarding, 'a%d' % n)
+
+    def pending_targets(self):
+        return sorted(job['target'] for job in self.bot.db.fetch_due_jobs(float('inf')))
+
+    def test_awards_coalesce_by_target(self):
+        now = datetime.now()
+        self.award(0)
+        self.award(1)
+        self.award(2, awardee='cat')
+
+        self.assertEqual(self.pending_targets(), ['first_award_message/amy',
+            'first_award_message/cat', 'leaders', 'scoreboard/%d/%d' % (now.year, now.month),
+            'user/amy', 'user/cat'])
+
+    def test_jobs_wait_for_debounce_window(self):
+        self.award(0)
+        self.bot.run_due_jobs()
+
+        self.assertEqual(self.bot.reddit.send_message.call_count, 1)
+        self.assertFalse(self.bot.reddit.edit_wiki_page.called)
+        self.assertEqual(len(self.pending_targets()), 3)
+
+    def test_due_jobs_run_once_each(self):
+        self.bot.update_debounce_window = 0
+        self.award(0)
+        self.award(1)
+        self.assertIsNone(self.bot.run_due_jobs())
+
+        pages = [c[0][1] for c in self.bot.reddit.edit_wiki_page.call_args_list]
+        now = datetime.now()
+        self.assertEqual(sorted(pages), ['scoreboard_%d_%d' % (now.year, now.month),
+            'user/amy'])
+        self.assertEqual(self.bot.subreddit.set_flair.call_args[0][1], '2∆')
+        self.assertEqual(self.pending_targets(), [])
+
+    @mock.patch('deltabot.logging')
+    def test_failed_job_is_kept(self, mock_logging):
+        self.bot.update_debounce_window = 0
+        self.award(0)
+        self.bot.reddit.edit_wiki_page.side_effect = ValueError('500')
+        self.bot.run_due_jobs()
+
+        self.assertEqual(self.pending_targets(), ['scoreboard/%d/%d' % (
+            datetime.now().year, datetime.now().month), 'user/amy'])
+
+    @mock.patch('deltabot.logging')
+    def test_failing_job_backs_off(self, mock_logging):
+        self.bot.db.enqueue_jobs([deltabot.update_job('user/amy', 'awardee', 0, awardee='amy')])
+        self.bot.reddit.edit_wiki_page.side_effect = ValueError('500')
+        for attempts in range(1, 4):
+            job, = self.bot.db.fetch_due_jobs(time.time() + 10000)
+            with mock.patch('deltabot.time.time', return_value=job['due_time']):
+                self.bot.run_due_jobs()
+            self.assertEqual(self.bot.db.fetch_next_job_time() - job['due_time'],
+                300 * 2 ** (attempts - 1))
+
+    @mock.patch('deltabot.logging')
+    def test_job_dropped_after_max_attempts(self, mock_logging):
+        self.bot.update_debounce_window = 0
+        self.bot.config.update_job_max_attempts = 3
+        self.bot.db.enqueue_jobs([deltabot.update_job('user/amy', 'awardee', 0, awardee='amy')])
+        self.bot.reddit.edit_wiki_page.side_effect = ValueError('500')
+        for _ in range(3):
+            self.bot.run_due_jobs()
+
+        self.assertEqual(self.bot.reddit.edit_wiki_page.call_count, 3)
+        self.assertEqual(self.pending_targets(), [])
+        mock_logging.error.assert_called_with(
+            "Giving up on %s after %d failed attempts" % ('user/amy', 3))
+
+    def test_job_changed_while_running_is_rescheduled(self):
+        self.bot.db.enqueue_jobs([deltabot.update_job('leaders', 'leaders', 0)])
+        job, = self.bot.db.fetch_due_jobs(0)
+        self.bot.db.enqueue_jobs([deltabot.update_job('leaders', 'leaders', 0)])
+
+        self.assertFalse(self.bot.db.complete_job(job, 100))
+        self.assertEqual(self.bot.db.fetch_next_job_time(), 100)
+
+class TestTemplates(DeltaBotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.comment = mock.Mock()
+        self.parent = mock.Mock()
+        self.parent.author.name = 'amy'
+
+    def test_templates_compile_on_first_use(self):
+        environment = self.bot.templates.environment
+        self.assertEqual(len(environment.cache), 0)
+        self.bot.get_reply_text(self.comment, deltabot.dispos['confirmed'], self.parent)
+        self.assertEqual(len(environment.cache), 1)
+
+    def test_static_reply_is_rendered_once(self):
+        environment = self.bot.templates.environment
+        dispo = deltabot.dispos['awarded_op']
+        with mock.patch.object(environment, 'get_template',
+                wraps=environment.get_template) as get_template:
+            text = self.bot.get_reply_text(self.comment, dispo)
+            self.assertEqual(self.bot.get_reply_text(self.comment, dispo), text)
+        self.assertEqual(get_template.call_count, 1)
+        self.assertFalse(self.bot.reddit.get_info.called)
+
+    def test_reply_depending_on_comment(self):
+        text = self.bot.get_reply_text(self.comment, deltabot.dispos['confirmed'], self.parent)
+        self.assertIn('/u/amy', text)
+        self.assertNotIn(deltabot.dispos['confirmed'], self.bot.static_replies)
+
+    def test_bytecode_is_cached_on_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            templates = deltabot.load_templates('./config/templates', tmp)
+            templates['replies']['awarded_op'].render()
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+class TestModeratorCache(DeltaBotTestCase):
+    def setUp(self):
+        super().setUp()
+        mod = mock.Mock()
+        mod.name = 'amy'
+        self.bot.reddit.get_moderators.return_value = [mod]
+
+    def message(self, subject):
+        message = mock.Mock(subject=subject, body='')
+        message.author.name = 'amy'
+        return message
+
+    def test_moderators_fetched_once(self):
+        self.assertTrue(self.bot.is_moderator('amy'))
+        self.assertFalse(self.bot.is_moderator('bob'))
+        self.assertEqual(self.bot.reddit.get_moderators.call_count, 1)
+
+    def test_moderators_refetched_after_ttl(self):
+        self.bot.moderators.clock = mock.Mock(return_value=0)
+        self.bot.is_moderator('amy')
+        self.bot.moderators.clock.return_value = self.bot.moderators.ttl
+        self.bot.is_moderator('amy')
+        self.assertEqual(self.bot.reddit.get_moderators.call_count, 2)
+
+    def test_reload_mods_command(self):
+        self.bot.scan_message(self.message('reload mods'))
+        self.bot.scan_message(self.message('rescan'))
+        self.assertEqual(self.bot.reddit.get_moderators.call_count, 2)
+
+class TestAsyncEngine(DeltaBotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bot.config.attrs['sleep_time'] = 0
+        self.bot.poll_interval = scheduler.AdaptivePollInterval(0, 0, 0)
+        self.engine = pipeline.AsyncEngine(self.bot)
+        self.comments = []
+        for name in ('t1_a', 't1_b', 't1_c'):
+            comment = mock.Mock(body='no token', parent_id='t3_sub', permalink=name)
+            comment.name = name
+            self.comments.append(comment)
+        self.bot.subreddit.get_comments.return_value = iter(self.comments)
+        self.bot.scan_inbox = mock.Mock(side_effect=self.stop)
+        self.bot.rescan_comments = mock.Mock()
+        self.bot.apply_dispo = mock.Mock()
+
+    def stop(self):
+        self.bot.running = False
+
+    def test_single_iteration(self):
+        self.engine.run()
+
+        self.assertEqual([call[0][0] for call in self.bot.apply_dispo.call_args_list],
+            self.comments)
+        self.assertEqual(self.bot.apply_dispo.call_args[0][1],
+            deltabot.dispos['comment_does_not_contain_token'])
+        self.assertEqual(list(self.bot.checkpoint.recent), ['t1_a', 't1_b', 't1_c'])
+        self.assertEqual(self.bot.db.fetch_checkpoint('comments')['high_water_mark'], 't1_c')
+        self.assertTrue(self.bot.rescan_comments.called)
+
+    def test_stage_error_stops_engine(self):
+        self.bot.apply_dispo.side_effect = ValueError('boom')
+        self.bot.scan_inbox = mock.Mock()
+
+        with self.assertRaises(ValueError):
+            self.engine.run()
+
+    def test_update_waits_a_minute_without_sleep_time(self):
+        del self.bot.config.attrs['sleep_time']
+        self.bot.run_due_jobs = mock.Mock(return_value=None)
+        self.bot.backfill_award_roots = mock.Mock()
+        self.engine.run_blocking = mock.AsyncMock(side_effect=lambda stage, f: f())
+        sleep = mock.AsyncMock(side_effect=asyncio.CancelledError)
+
+        with mock.patch('pipeline.asyncio.sleep', sleep):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(self.engine.update())
+        sleep.assert_called_once_with(60)
+
+    def test_revalidate_downgrades_award_made_redundant(self):
+        self.bot.already_awarded_by_bot = mock.Mock(return_value=True)
+        self.assertEqual(self.engine.revalidate(self.comments[0],
+            deltabot.dispos['confirmed'], None), deltabot.dispos['already_awarded_by_bot'])
+
+class TestRequestScheduler(unittest.TestCase):
+    class GatedBucket(object):
+        """ Hands out only the tokens a test has released """
+        def __init__(self):
+            self.tokens = 0
+
+        def try_acquire(self):
+            if self.tokens:
+                self.tokens -= 1
+                return 0
+            return 0.01
+
+    def setUp(self):
+        self.bucket = self.GatedBucket()
+        self.scheduler = scheduler.RequestScheduler(self.bucket)
+
+    def wait_until(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def test_higher_priority_goes_first(self):
+        calls = []
+        threads = [threading.Thread(target=self.scheduler.call,
+                       args=(priority, calls.append, priority))
+                   for priority in (scheduler.WIKI, scheduler.REPLY)]
+        threads[0].start()
+        self.wait_until(lambda: self.scheduler.queue_depth[scheduler.WIKI])
+        threads[1].start()
+        self.wait_until(lambda: self.scheduler.queue_depth[scheduler.REPLY])
+
+        self.bucket.tokens = 1
+        self.wait_until(lambda: calls)
+        self.assertEqual(calls, [scheduler.REPLY])
+        self.bucket.tokens = 1
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [scheduler.REPLY, scheduler.WIKI])
+
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['reply']['requests'], 1)
+        self.assertEqual(stats['wiki']['queue_depth'], 0)
+
+    def test_iterate_schedules_each_step(self):
+        self.bucket.tokens = 3
+        self.assertEqual(list(self.scheduler.iterate(scheduler.REPLY, 'ab',
+            endpoint='get_comments')), ['a', 'b'])
+        self.assertEqual(self.scheduler.requests[scheduler.REPLY], 3)
+        self.assertEqual(self.scheduler.endpoint_calls, {'get_comments': 3})
+
+class TestRescan(DeltaBotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.comments = {}
+        self.bot.reddit.get_info.side_effect = lambda thing_id: [
+            self.comments[name] for name in thing_id if name in self.comments]
+        self.bot.dispo_comment = mock.Mock(
+            return_value=(deltabot.dispos['too_little_text'], None))
+        self.bot.apply_dispo = mock.Mock()
+
+    def log(self, comment_id, dispo=deltabot.dispos['too_little_text'], age=0):
+        comment = mock.Mock(id=comment_id, body='short', created_utc=time.time() - age,
+            permalink=comment_id)
+        comment.name = 't1_' + comment_id
+        self.comments[comment.name] = comment
+        self.bot.db.log_dispo(comment, dispo, mock.Mock(id='r' + comment_id),
+            self.bot.next_rescan_time(dispo))
+
+    def rescan_later(self, seconds):
+        with mock.patch('time.time', return_value=time.time() + seconds):
+            self.bot.rescan_comments()
+
+    def test_only_due_rescannable_logs_are_rescanned(self):
+        self.log('a')
+        self.log('b', dispo=deltabot.dispos['confirmed'])
+        self.log('c', age=30 * 24 * 60 * 60)
+
+        self.bot.rescan_comments()
+        self.assertFalse(self.bot.reddit.get_info.called)
+        self.rescan_later(self.bot.config.rescan_interval)
+
+        self.bot.reddit.get_info.assert_called_once_with(thing_id=['t1_a'])
+        self.bot.dispo_comment.assert_called_once_with(self.comments['t1_a'])
+
+    def test_unchanged_comment_backs_off(self):
+        self.log('a')
+        interval = self.bot.config.rescan_interval
+        self.rescan_later(interval)
+        self.rescan_later(interval + interval)
+        self.rescan_later(interval + 2 * interval)
+        self.assertEqual(self.bot.dispo_comment.call_count, 2)
+
+        self.rescan_later(interval + 2 * interval + 4 * interval)
+        self.assertEqual(self.bot.dispo_comment.call_count, 3)
+        self.assertFalse(self.bot.apply_dispo.called)
+
+    def test_changed_comment_is_applied(self):
+        self.log('a')
+        self.log('b')
+        self.bot.dispo_comment.side_effect = lambda comment: (
+            deltabot.dispos['confirmed'] if comment.id == 'a'
+            else deltabot.dispos['too_little_text'], 'parent')
+        self.rescan_later(self.bot.config.rescan_interval)
+
+        self.assertEqual(self.bot.reddit.get_info.call_count, 1)
+        self.bot.apply_dispo.assert_called_once_with(self.comments['t1_a'],
+            deltabot.dispos['confirmed'], 'parent')
+
+    def test_comment_already_awarded_is_not_rescanned_again(self):
+        self.log('a')
+        del self.bot.apply_dispo  # the real one
+        self.bot.dispo_comment.return_value = (
+            deltabot.dispos['already_awarded_by_bot'], 'parent')
+        self.rescan_later(self.bot.config.rescan_interval)
+        self.rescan_later(self.bot.config.rescan_max_interval)
+
+        self.assertEqual(self.bot.dispo_comment.call_count, 1)
+        self.assertEqual(self.bot.db.fetch_due_rescans(float('inf'), 0, 10), [])
+
+class TestAdaptivePollInterval(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=0)
+        self.interval = scheduler.AdaptivePollInterval(60, 10, 300,
+            target_comments=25, smoothing=0.5, clock=self.clock)
+
+    def poll(self, elapsed, new_comments):
+        self.clock.return_value += elapsed
+        return self.interval.observe(new_comments)
+
+    def test_first_poll_keeps_initial_interval(self):
+        self.assertEqual(self.poll(0, 100), 60)
+
+    def test_interval_follows_comment_rate(self):
+        self.poll(0, 0)
+        self.assertEqual(self.poll(60, 30), 50)
+        self.assertEqual(self.interval.stats(), {'comments_per_second': 0.5, 'interval': 50})
+        # the rate is smoothed, so a burst shortens the interval gradually
+        self.assertAlmostEqual(self.poll(50, 100), 20)
+        self.assertAlmostEqual(self.interval.rate, 1.25)
+
+    def test_interval_is_bounded(self):
+        self.poll(0, 0)
+        self.assertEqual(self.poll(60, 6000), 10)
+        for _ in range(20):
+            self.poll(300, 0)
+        self.assertEqual(self.interval.interval, 300)
+
+class TestScanCheckpoint(DeltaBotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bot.process_comment = mock.Mock()
+
+    def comment(self, name):
+        comment = mock.Mock(body='no token', parent_id='t3_sub')
+        comment.name = name
+        return comment
+
+    def listing(self, *names):
+        # the comments listing is newest first
+        self.bot.subreddit.get_comments.return_value = iter([self.comment(name)
+            for name in sorted(names, key=checkpoint.fullname_key, reverse=True)])
+
+    def processed(self):
+        return [call[0][0].name for call in self.bot.process_comment.call_args_list]
+
+    def test_fullnames_order_by_id(self):
+        self.assertLess(checkpoint.fullname_key('t1_z'), checkpoint.fullname_key('t1_10'))
+
+    def test_late_comment_inside_window_is_new(self):
+        scan_checkpoint = checkpoint.ScanCheckpoint(window=3)
+        scan_checkpoint.advance(['t1_a', 't1_c'])
+        self.assertTrue(scan_checkpoint.is_new('t1_b'))
+        self.assertFalse(scan_checkpoint.is_new('t1_c'))
+        self.assertTrue(scan_checkpoint.is_behind('t1_9'))
+        self.assertEqual(scan_checkpoint.high_water_mark, 't1_c')
+
+    def test_scan_resumes_after_checkpoint(self):
+        self.listing('t1_a', 't1_b')
+        self.bot.scan_comments()
+        self.listing('t1_a', 't1_b', 't1_c', 't1_10')
+        self.bot.scan_comments()
+
+        self.assertEqual(self.processed(), ['t1_a', 't1_b', 't1_c', 't1_10'])
+        self.assertFalse(self.bot.reddit.get_info.called)
+        self.assertEqual(self.bot.load_checkpoint().high_water_mark, 't1_10')
+
+    def test_deleted_anchor_needs_no_lookup(self):
+        self.listing('t1_a', 't1_b')
+        self.bot.scan_comments()
+        self.listing('t1_a', 't1_c')
+        self.bot.scan_comments()
+
+        self.assertEqual(self.processed(), ['t1_a', 't1_b', 't1_c'])
+        self.assertFalse(self.bot.reddit.get_info.called)
+
+    def test_saved_id_file_is_migrated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'prev_id.txt')
+            with open(path, 'w') as f:
+                f.write('t1_b')
+            self.bot.config.attrs['last_comment_filename'] = path
+            self.bot.db.delete_checkpoint('comments')
+            self.assertEqual(self.bot.load_checkpoint().high_water_mark, 't1_b')
+
+        self.listing('t1_a', 't1_b', 't1_c')
+        self.bot.checkpoint = self.bot.load_checkpoint()
+        self.bot.scan_comments()
+        self.assertEqual(self.processed(), ['t1_c'])
+
+    def test_reset_command_clears_checkpoint(self):
+        self.listing('t1_a')
+        self.bot.scan_comments()
+        message = mock.Mock(subject='reset', body='')
+        self.bot.is_moderator = mock.Mock(return_value=True)
+        self.bot.scan_message(message)
+
+        self.assertIsNone(self.bot.checkpoint.high_water_mark)
+        self.assertIsNone(self.bot.db.fetch_checkpoint('comments'))
+
+class TestSharding(DeltaBotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manager = db.DatabaseManager(':memory:')
+        self.requests = queue.Queue()
+        self.responses = [queue.Queue(), queue.Queue()]
+        self.writer = threading.Thread(target=sharding.serve_database,
+            args=(self.manager, self.requests, self.responses))
+        self.writer.start()
+        self.remotes = [sharding.RemoteDatabase(self.requests, self.responses[n], n)
+                        for n in range(2)]
+
+    def tearDown(self):
+        self.requests.put(None)
+        self.writer.join()
+
+    def test_shard_of_is_stable(self):
+        shards = [deltabot.shard_of('s%d' % n, 4) for n in range(1000)]
+        self.assertEqual(shards, [deltabot.shard_of('s%d' % n, 4) for n in range(1000)])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+
+    def test_awards_are_seen_by_every_shard(self):
+        awarded, awarding = mock_award()
+        award = self.remotes[0].award_point(awarded, awarding, 'root')
+
+        self.assertEqual(award['submission_title'], 'title')
+        self.assertTrue(self.remotes[1].already_awarded_by_bot(awarding))
+        self.assertTrue(self.manager.previous_awards_in_submission(awarded, awarding, 'root'))
+
+    def test_unit_of_work_is_sent_as_one_batch(self):
+        comment = SimpleNamespace(id='c1', created_utc=0)
+        with self.remotes[0].unit_of_work():
+            self.remotes[0].log_dispo(comment, 6, SimpleNamespace(id='r1'))
+            self.remotes[0].save_checkpoint('comments/0', 't1_a', ['t1_a'])
+            self.assertTrue(self.requests.empty())
+            self.assertIsNone(self.manager.fetch_dispo_log_by_comment(comment))
+        self.assertEqual(self.remotes[1].fetch_dispo_log_by_comment(comment)['reply_id'], 'r1')
+
+    def test_unit_of_work_dropped_if_block_raises(self):
+        comment = SimpleNamespace(id='c1', created_utc=0)
+        with self.assertRaises(ValueError):
+            with self.remotes[0].unit_of_work():
+                self.remotes[0].log_dispo(comment, 6, SimpleNamespace(id='r1'))
+                raise ValueError('boom')
+        self.remotes[0].flush()
+        self.assertIsNone(self.remotes[1].fetch_dispo_log_by_comment(comment))
+
+    def test_writer_errors_reach_the_worker(self):
+        with self.assertRaises(RuntimeError):
+            self.remotes[0].fetch_checkpoint()
+
+    def test_shard_scans_only_its_submissions(self):
+        bot_config = config.Config(dict(test_config.attrs, database=':memory:'))
+        bot = deltabot.DeltaBot(bot_config, mock.create_autospec(praw.Reddit)(),
+            shard=(1, 2))
+        bot.process_comment = mock.Mock()
+        comments = []
+        for n in range(20):
+            comment = mock.Mock(body='no token', parent_id='t3_s%d' % n, link_id='t3_s%d' % n)
+            comment.name = 't1_%d' % (n + 10)
+            comments.append(comment)
+        bot.subreddit.get_comments.return_value = iter(reversed(comments))
+        bot.scan_comments()
+
+        self.assertEqual([call[0][0] for call in bot.process_comment.call_args_list],
+            [comment for comment in comments if deltabot.shard_of(comment.link_id[3:], 2) == 1])
+        self.assertEqual(bot.db.fetch_checkpoint('comments/1')['high_water_mark'], 't1_29')
+        self.assertFalse(bot.is_primary())
+
+    def shard_bot(self, shard, **kwargs):
+        bot_config = config.Config(dict(test_config.attrs, database=':memory:'))
+        return deltabot.DeltaBot(bot_config, mock.create_autospec(praw.Reddit)(),
+            database=self.remotes[shard], shard=(shard, 2), **kwargs)
+
+    def test_reset_reaches_every_shard(self):
+        bots = [self.shard_bot(0), self.shard_bot(1)]
+        bots[1].checkpoint.advance(['t1_a'])
+        bots[1].save_checkpoint()
+
+        bots[0].reset_checkpoint()
+        self.assertIsNone(self.manager.fetch_checkpoint('comments/1'))
+        bots[1].save_checkpoint()
+        bots[1].follow_checkpoint_reset()
+
+        self.assertIsNone(bots[1].checkpoint.high_water_mark)
+        self.assertIsNone(self.manager.fetch_checkpoint('comments/1'))
+        bots[1].follow_checkpoint_reset()
+        self.assertEqual(bots[1].checkpoint_resets, 1)
+
+    def test_stop_ends_the_main_loop(self):
+        stop = threading.Event()
+        bot = self.shard_bot(1, stop=stop)
+        bot.scan_comments = mock.Mock(side_effect=lambda: stop.set() or 0)
+
+        bot.go()
+
+        self.assertEqual(bot.scan_comments.call_count, 1)
+
+class TestShardingProcessQueues(unittest.TestCase):
+    """ The writer behind multiprocessing queues, which pickle everything
+    sent through them """
+    def setUp(self):
+        self.manager = db.DatabaseManager(':memory:')
+        self.requests = multiprocessing.Queue()
+        self.responses = [multiprocessing.Queue()]
+        self.writer = threading.Thread(target=sharding.serve_database,
+            args=(self.manager, self.requests, self.responses))
+        self.writer.start()
+        self.remote = sharding.RemoteDatabase(self.requests, self.responses[0], 0)
+
+    def tearDown(self):
+        self.requests.put(None)
+        self.writer.join()
+
+    def call(self, fn, *args):
+        """ Calls fn from a thread, failing rather than hanging if the
+        response never arrives """
+        outcome = queue.Queue()
+        def run():
+            try:
+                outcome.put((True, fn(*args)))
+            except Exception as e:
+                outcome.put((False, e))
+        threading.Thread(target=run, daemon=True).start()
+        ok, result = outcome.get(timeout=10)
+        if not ok:
+            raise result
+        return result
+
+    def test_previous_awards_reach_the_worker(self):
+        awarded, awarding = mock_award()
+        self.call(self.remote.award_point, awarded, awarding, 'root')
+
+        self.assertEqual(self.call(self.remote.previous_awards_in_submission,
+            awarded, awarding, 'root'), ['awarding'])
+
+    def test_unpicklable_result_is_an_error(self):
+        self.manager.fetch_state = lambda key, default=None: threading.Lock()
+        with self.assertRaises(RuntimeError):
+            self.call(self.remote.fetch_state, 'key')
+
+class TestTokenMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = deltabot.TokenMatcher(test_config.tokens)
+        self.token = test_config.tokens[0]
+
+    def test_token_in_plain_text(self):
+        self.assertTrue(self.matcher.contains_token("I changed my mind " + self.token))
+
+    def test_no_token(self):
+        self.assertFalse(self.matcher.contains_token("Nothing to see here\n\nat all"))
+
+    def test_token_in_quote(self):
+        body = "&gt; you gave " + self.token + "\nstill quoted\n\nmy reply"
+        self.assertFalse(self.matcher.contains_token(body))
+
+    def test_token_in_code_block(self):
+        body = "example:\n\n    print('" + self.token + "')"
+        self.assertFalse(self.matcher.contains_token(body))
+
+    def test_token_after_quote_ends(self):
+        body = "&gt; quoted\nstill quoted\n\n" + self.token + " for you"
+        self.assertTrue(self.matcher.contains_token(body))
+
+    def test_token_above_quote_in_same_paragraph(self):
+        body = self.token + " here\n&gt; quote below"
+        self.assertTrue(self.matcher.contains_token(body))
+
+    def test_no_tokens_configured(self):
+        self.assertFalse(deltabot.TokenMatcher([]).contains_token(self.token))
+
+    def test_agrees_with_legacy_matcher(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            body = benchmarks.random_comment_body(rng, paragraphs=rng.randint(1, 6),
+                token_rate=0.7, quote_rate=0.5)
+            self.assertEqual(self.matcher.contains_token(body),
+                benchmarks.legacy_str_contains_token(body, test_config.tokens), body)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.metrics = metrics.Metrics(clock=lambda: self.now)
+
+    def test_phases_and_iteration_deltas(self):
+        api_calls = collections.Counter()
+        self.metrics.add_counter('deltabot_api_requests_total', 'api_calls',
+            "API calls.", 'endpoint', api_calls)
+        with self.metrics.phase('scan'):
+            self.now += 2
+        api_calls['get_info'] += 3
+        self.metrics.count_dispo('confirmed')
+        first = self.metrics.end_iteration(new_comments=5)
+        self.assertEqual(first['phases'], {'scan': 2})
+        self.assertEqual(first['api_calls'], {'get_info': 3})
+        self.assertEqual(first['dispos'], {'confirmed': 1})
+        self.assertEqual((first['seconds'], first['new_comments']), (2, 5))
+
+        api_calls['get_info'] += 1
+        second = self.metrics.end_iteration()
+        self.assertEqual(second['api_calls'], {'get_info': 1})
+        self.assertEqual(second['phases'], {})
+        self.assertEqual(second['iteration'], 2)
+
+    def test_render_prometheus_text(self):
+        with self.metrics.phase('rescan'):
+            self.now += 1.5
+        self.metrics.count_dispo('too_little_text')
+        self.metrics.end_iteration()
+        text = self.metrics.render()
+        self.assertIn('# TYPE deltabot_phase_seconds_total counter\n', text)
+        self.assertIn('deltabot_phase_seconds_total{phase="rescan"} 1.5\n', text)
+        self.assertIn('deltabot_comments_total{dispo="too_little_text"} 1\n', text)
+        self.assertIn('deltabot_iterations_total 1\n', text)
+
+    def test_serve(self):
+        server = metrics.serve(self.metrics, 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://%s:%d/metrics' % server.server_address
+        with urllib.request.urlopen(url) as response:
+            self.assertIn(b'deltabot_iterations_total 0', response.read())
+
+
+class TestBotMetrics(DeltaBotTestCase):
+    def test_iteration_is_logged_and_exported(self):
+        comment = mock.Mock(body='no token', parent_id='t3_sub', permalink='t1_a')
+        comment.name = 't1_a'
+        self.bot.subreddit.get_comments.return_value = iter([comment])
+        self.bot.scan_inbox = mock.Mock(side_effect=lambda: setattr(self.bot, 'running', False))
+        self.bot.rescan_comments = mock.Mock()
+        with tempfile.TemporaryDirectory() as tmp:
+            self.bot.config.attrs['metrics_file'] = os.path.join(tmp, 'deltabot.prom')
+            with mock.patch('time.sleep'), self.assertLogs(level='INFO') as logs:
+                self.bot.go()
+            with open(self.bot.config.metrics_file) as f:
+                exported = f.read()
+
+        line = [line for line in logs.output if 'Iteration metrics: ' in line][-1]
+        summary = json.loads(line.split('Iteration metrics: ', 1)[1])
+        self.assertEqual(summary['new_comments'], 1)
+        self.assertEqual(summary['dispos'], {'comment_does_not_contain_token': 1})
+        self.assertEqual(set(summary['phases']), {'inbox', 'scan', 'rescan'})
+        self.assertIn('get_comments', summary['api_calls'])
+        self.assertGreater(summary['db_calls']['save_checkpoint'], 0)
+        self.assertNotIn('write', summary['db_calls'])
+        self.assertIn('deltabot_db_calls_total{method="save_checkpoint"}', exported)
+
+class TestFakeReddit(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_reddit.FakeReddit(test_config.subreddit,
+            [test_config.account['username']])
+        self.faults = fake_reddit.Faults(rng=random.Random(0))
+        self.server = fake_reddit.serve(self.fake, self.faults)
+        self.url = 'http://%s:%d' % self.server.server_address
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def make_bot(self):
+        praw.BaseReddit.update_checked = True
+        bot_config = config.Config(dict(test_config.attrs, database=':memory:',
+            reddit_url=self.url, last_comment_filename=None,
+            api_requests_per_minute=60000, api_burst=1000))
+        with warnings.catch_warnings():
+            # PRAW warns about the user agent and about password logins
+            warnings.simplefilter('ignore')
+            reddit = deltabot.reddit_client(bot_config)
+            reddit.config.api_request_delay = 0
+            return deltabot.DeltaBot(bot_config, reddit)
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen(self.url + path) as response:
+                return response.status, response.headers, json.load(response)
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers, None
+
+    def test_bot_awards_through_praw(self):
+        submission = self.fake.add_submission('op', 'title', 'text')
+        parent = self.fake.add_comment(submission['name'], 'amy', 'x' * 200)
+        comment = self.fake.add_comment(parent['name'], 'bob',
+            'y' * 200 + test_config.tokens[0])
+        bot = self.make_bot()
+        self.assertEqual(bot.scan_comments(), 2)
+        reply = self.fake.things[self.fake.comments[-1]]
+        self.assertEqual(reply['parent_id'], comment['name'])
+        self.assertEqual(reply['author'], test_config.account['username'])
+        self.assertEqual(reply['distinguished'], 'moderator')
+        self.assertEqual(bot.db.fetch_awards_by_awardee('amy')[0]['awarding_comment_id'],
+            comment['id'])
+
+    def test_listing_pages_newest_first(self):
+        submission = self.fake.add_submission('op')
+        names = [self.fake.add_comment(submission['name'], 'amy', 'text')['name']
+                 for _ in range(150)]
+        _, _, first = self.get('/r/%s/comments.json?limit=100' % test_config.subreddit)
+        _, _, second = self.get('/r/%s/comments.json?limit=100&after=%s' % (
+            test_config.subreddit, first['data']['after']))
+        listed = [child['data']['name'] for page in (first, second)
+                  for child in page['data']['children']]
+        self.assertEqual(listed, names[::-1])
+        self.assertIsNone(second['data']['after'])
+
+    def test_rate_limit_window(self):
+        self.faults.requests_per_window = 2
+        statuses = [self.get('/api/info.json?id=t1_x')[:2] for _ in range(3)]
+        self.assertEqual([status for status, _ in statuses], [200, 200, 429])
+        self.assertEqual(statuses[1][1]['X-Ratelimit-Remaining'], '0')
+        self.assertIn('Retry-After', statuses[2][1])
+
+    def test_error_injection(self):
+        self.faults.error_rate = 1
+        self.faults.error_status = 503
+        self.assertEqual(self.get('/api/info.json?id=t1_x')[0], 503)
+        self.assertEqual(self.faults.injected, {503: 1})
+
+class TestLoadBenchmark(unittest.TestCase):
+    def test_stream_builds_deep_trees_in_order(self):
+        reddit = praw_mocks.Reddit()
+        stream = benchmarks.synthetic_comment_stream(reddit, random.Random(0),
+            users=20, submissions=2, depth_rate=1.0)
+        comments = [next(stream) for _ in range(50)]
+        keys = [checkpoint.fullname_key(comment.name) for comment in comments]
+        self.assertEqual(keys, sorted(keys))
+        self.assertTrue(any(reddit.get_info(comment.parent_id).parent_id.startswith('t1_')
+            for comment in comments if comment.parent_id.startswith('t1_')))
+        self.assertEqual(reddit.subreddit.comments, comments)
+
+    def test_load_writes_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'load.json')
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(benchmarks.main(['load', '--iterations', '3',
+                    '--per-iteration', '150', '--token-rate', '0.3', '--memory',
+                    '--output', output]), 0)
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(results['comments'], 450)
+        self.assertGreater(results['awards'], 0)
+        self.assertGreater(results['api_calls_by_endpoint']['reply'], 0)
+        self.assertLessEqual(results['iteration_latency_ms']['p50'],
+            results['iteration_latency_ms']['p99'])
 
 if __name__ == '__main__':
     unittest.main()